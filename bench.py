@@ -0,0 +1,363 @@
+import argparse
+import datetime
+import http.server
+import io
+import json
+import os
+import pathlib
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zipfile
+import yaml
+from settings import Games, Kh1525, LaunchKh1, LaunchKh2, LaunchKhBbs, LaunchKhRecom, Luabackend, Mods, OpenKh, Panacea, Randomizer, Refined, Settings, get_settings, save_settings
+
+SCRIPT = pathlib.Path(__file__).parent / 'kh.py'
+
+STUB_WINE = '''
+import os, pathlib, sys
+
+def unix(path):
+   if len(path) > 1 and path[1] == ':':
+      return pathlib.Path(path[2:].replace('\\\\', '/'))
+   return pathlib.Path(path)
+
+def option(args, name):
+   return args[args.index(name) + 1]
+
+args = sys.argv[1:]
+prefix = pathlib.Path(os.environ['WINEPREFIX'])
+if args[0] == 'wineboot':
+   (prefix / 'drive_c/users' / os.environ['USER'] / 'Documents').mkdir(parents=True, exist_ok=True)
+elif args[0] == 'reg':
+   pass
+elif args[0].endswith('OpenKh.Command.IdxImg.exe'):
+   if not unix(args[0]).exists():
+      sys.exit(f'stub wine: {args[0]} does not exist')
+   match args[1:3]:
+      case ['hed', 'extract']:
+         output = unix(option(args, '--output')) / 'original'
+         output.mkdir(parents=True, exist_ok=True)
+         (output / unix(args[-1]).stem).write_bytes(os.urandom(4096))
+      case ['hed', 'build']:
+         output = unix(option(args, '--output_folder'))
+         (output / 'dll/modules').mkdir(parents=True, exist_ok=True)
+         (output / 'built').write_text(option(args, '--enabled_mods'))
+      case ['hed', 'full-patch']:
+         pass
+      case _:
+         sys.exit(f'stub wine: unknown IdxImg command {args[1:3]}')
+else:
+   sys.exit(f'stub wine: unknown executable {args[0]}')
+'''
+
+STUB_WINEPATH = '''
+import sys
+mode, path = sys.argv[1], sys.argv[2]
+if mode == '--windows':
+   print('Z:' + path.replace('/', '\\\\'))
+else:
+   print(path[2:].replace('\\\\', '/') if path[1:2] == ':' else path)
+'''
+
+STUB_WINETRICKS = '''
+import os, pathlib, sys
+with open(pathlib.Path(os.environ['WINEPREFIX']) / 'winetricks.log', 'a', encoding='utf-8') as log:
+   log.writelines(arg + '\\n' for arg in sys.argv[1:] if not arg.startswith('-'))
+'''
+
+STUB_NOOP = '''
+'''
+
+class Releases(http.server.ThreadingHTTPServer):
+   def __init__(self):
+      super().__init__(('127.0.0.1', 0), ReleaseHandler)
+      self.files: dict[str, tuple[str, bytes]] = {}
+      self.bytes_sent = 0
+      self.url = f'http://127.0.0.1:{self.server_address[1]}'
+
+   def add_release(self, path: str, tag: str, assets: dict[str, bytes]):
+      updated = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+      release = {
+         'tag_name': tag,
+         'published_at': updated,
+         'assets': [{
+            'name': name,
+            'updated_at': updated,
+            'size': len(data),
+            'browser_download_url': f'{self.url}/assets/{tag}/{name}',
+         } for name, data in assets.items()],
+      }
+      self.files[path] = ('application/json', json.dumps(release).encode('utf-8'))
+      for name, data in assets.items():
+         self.files[f'/assets/{tag}/{name}'] = ('application/octet-stream', data)
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+   server: Releases
+
+   def do_GET(self):
+      entry = self.server.files.get(self.path)
+      if entry is None:
+         self.send_error(404)
+         return
+      content_type, data = entry
+      total = len(data)
+      requested = self.headers.get('Range')
+      if requested is not None and requested.startswith('bytes=') and ',' not in requested:
+         first, last = requested.removeprefix('bytes=').split('-')
+         if first == '':
+            start, end = max(total - int(last), 0), total - 1
+         else:
+            start, end = int(first), total - 1 if last == '' else min(int(last), total - 1)
+         if start > end:
+            self.send_error(416)
+            return
+         data = data[start:end + 1]
+         self.send_response(206)
+         self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+      else:
+         self.send_response(200)
+      self.send_header('Accept-Ranges', 'bytes')
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+      self.server.bytes_sent += len(data)
+
+   def log_message(self, format: str, *args: typing.Any):
+      pass
+
+def make_zip(files: dict[str, bytes]) -> bytes:
+   buffer = io.BytesIO()
+   with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+      for name, data in files.items():
+         archive.writestr(name, data)
+   return buffer.getvalue()
+
+def make_stubs(folder: pathlib.Path):
+   folder.mkdir(parents=True, exist_ok=True)
+   for name, body in [('wine', STUB_WINE), ('umu-run', STUB_WINE), ('winepath', STUB_WINEPATH), ('winetricks', STUB_WINETRICKS), ('wineserver', STUB_NOOP)]:
+      stub = folder / name
+      stub.write_text(f'#!{sys.executable}\n{body}', encoding='utf-8')
+      stub.chmod(0o755)
+
+def make_game(folder: pathlib.Path, image_size: int):
+   for exe in [LaunchKh1.exe(), LaunchKh2.exe(), LaunchKhBbs.exe(), LaunchKhRecom.exe()]:
+      (folder / exe).parent.mkdir(parents=True, exist_ok=True)
+      (folder / exe).write_bytes(b'MZ')
+   image = folder / 'Image'
+   image.mkdir(parents=True, exist_ok=True)
+   for gameid in ['kh1', 'kh2', 'bbs', 'Recom']:
+      (image / f'{gameid}_first.hed').write_bytes(os.urandom(1024))
+      (image / f'{gameid}_first.pkg').write_bytes(os.urandom(image_size))
+
+def make_mods(remotes: pathlib.Path, count: int, files: int) -> list[str]:
+   names: list[str] = []
+   for index in range(count):
+      name = f'bench/mod{index:03}'
+      repo = remotes / name
+      (repo / 'assets').mkdir(parents=True, exist_ok=True)
+      (repo / 'mod.yml').write_text(f'title: Bench mod {index}\n', encoding='utf-8')
+      for file in range(files):
+         (repo / 'assets' / f'{file:04}.bin').write_bytes(os.urandom(256))
+      git(['init', '--quiet', '--initial-branch=main'], repo)
+      git(['add', '-A'], repo)
+      git(['commit', '--quiet', '-m', 'Initial'], repo)
+      names.append(name)
+   return names
+
+def git(args: list[str], cwd: pathlib.Path):
+   subprocess.run(
+      ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', *args],
+      cwd=cwd,
+      check=True,
+      stdout=subprocess.DEVNULL
+   )
+
+def make_settings(root: pathlib.Path) -> Settings:
+   extra = root / 'extra'
+   return Settings(
+      epic_id = 1,
+      steam_id = None,
+      runtime = 'wine',
+      store = 'epic',
+      games = Games(
+         kh15_25 = Kh1525(
+            wineprefix = extra / 'wineprefix',
+            saves = extra / 'saves',
+            folder = root / 'game',
+            workspace = None,
+            kh1 = LaunchKh1(launch = extra / 'launch/kh1'),
+            kh2 = LaunchKh2(launch = extra / 'launch/kh2'),
+            khrecom = LaunchKhRecom(launch = extra / 'launch/khrecom'),
+            khbbs = LaunchKhBbs(launch = extra / 'launch/khbbs'),
+         ),
+         kh28 = None,
+         kh3 = None,
+         khmom = None,
+      ),
+      mods = Mods(
+         openkh = OpenKh(
+            folder = extra / 'openkh',
+            mods = extra / 'mods',
+            settings = None,
+            panacea = Panacea(settings = extra / 'panacea/panacea_settings.txt'),
+            update_mods = True,
+            update = True,
+            last_build = None,
+            check_interval = 24,
+            mods_check_interval = 24,
+         ),
+         luabackend = Luabackend(
+            folder = extra / 'luabackend',
+            settings = extra / 'luabackend/LuaBackend.toml',
+            scripts = extra / 'scripts',
+            update = True,
+            check_interval = 24,
+         ),
+         refined = Refined(
+            folder = extra / 'refined',
+            settings = extra / 'refined/reFined.cfg',
+            disabled_modules = [],
+         ),
+         randomizer = Randomizer(
+            folder = extra / 'randomizer',
+            update = True,
+            check_interval = 24,
+         ),
+         kh3 = None,
+      ),
+   )
+
+def add_releases(server: Releases) -> dict[str, bytes]:
+   openkh = {f'openkh/{name}': os.urandom(64 * 1024) for name in ['OpenKh.Command.IdxImg.exe', 'OpenKh.Command.IdxImg.dll', 'OpenKH.Panacea.dll', 'bass.dll', 'bass_vgmstream.dll']}
+   openkh |= {f'openkh/lib{index:03}.dll': os.urandom(16 * 1024) for index in range(200)}
+   server.add_release('/repos/OpenKH/OpenKh/releases/tags/latest', 'latest', {'openkh.zip': make_zip(openkh)})
+   server.add_release('/repos/Sirius902/LuaBackend/releases/latest', 'v1.0.0', {'DBGHELP.zip': make_zip({'DBGHELP.dll': os.urandom(256 * 1024), 'LuaBackend.toml': b''})})
+   server.add_release('/repos/tommadness/KH2Randomizer/releases/latest', 'v1.0.0', {'Kingdom.Hearts.II.Final.Mix.Randomizer.zip': make_zip({'KH2Randomizer.exe': os.urandom(1024 * 1024)})})
+   return openkh
+
+def timed(results: dict[str, list[float]], name: str, action: typing.Callable[[], typing.Any]):
+   start = time.perf_counter()
+   action()
+   results.setdefault(name, []).append(time.perf_counter() - start)
+
+def run_kh(args: list[str], env: dict[str, str], log: typing.TextIO):
+   subprocess.run(
+      [sys.executable, str(SCRIPT), *args],
+      env=env,
+      check=True,
+      stdin=subprocess.DEVNULL,
+      stdout=log,
+      stderr=subprocess.STDOUT
+   )
+
+def check_build(settings_path: pathlib.Path, gameid: str):
+   openkh = get_settings(settings_path).mods.openkh
+   assert openkh is not None
+   with open(openkh.folder / 'mods-manager.yml', 'r', encoding='utf-8') as manager_file:
+      manager = yaml.safe_load(manager_file)
+   def unix(path: str) -> pathlib.Path:
+      return pathlib.Path(path[2:].replace('\\', '/') if path[1:2] == ':' else path)
+   built = unix(manager['gameModPath']) / gameid / 'built'
+   data = unix(manager['gameDataPath']) / gameid
+   if not built.exists() or not data.exists():
+      raise RuntimeError(f'update didn\'t build {gameid} mods (expected \'{built}\' and \'{data}\')')
+
+def main():
+   parser = argparse.ArgumentParser(description='Time kh.py against synthetic fixtures with stub wine and a local GitHub stand-in')
+   parser.add_argument('--iterations', type=int, default=3)
+   parser.add_argument('--mods', type=int, default=20, help='number of fake mod repos')
+   parser.add_argument('--mod-files', type=int, default=200, help='files per fake mod repo')
+   parser.add_argument('--image-size', type=int, default=1024 * 1024, help='bytes per fake Image pkg file')
+   parser.add_argument('--output', type=pathlib.Path, help='write results as JSON to this file')
+   parser.add_argument('--keep', action='store_true', help='keep the fixture folder for inspection')
+   args = parser.parse_args()
+
+   root = pathlib.Path(tempfile.mkdtemp(prefix='kh-bench-'))
+   server = Releases()
+   thread = threading.Thread(target=server.serve_forever, daemon=True)
+   thread.start()
+   results: dict[str, list[float]] = {}
+   delta_bytes: list[int] = []
+   try:
+      print(f'Building fixtures in \'{root}\'')
+      make_stubs(root / 'bin')
+      make_game(root / 'game', args.image_size)
+      mod_names = make_mods(root / 'remotes', args.mods, args.mod_files)
+      openkh_files = add_releases(server)
+      settings_path = root / 'settings.yaml'
+      save_settings(make_settings(root), settings_path)
+      env = dict(os.environ)
+      env |= {
+         'PATH': f'{root / "bin"}{os.pathsep}{env.get("PATH", "")}',
+         'USER': 'bench',
+         'LOGNAME': 'bench',
+         'HOME': str(root / 'home'),
+         'XDG_CACHE_HOME': str(root / 'home/.cache'),
+         'XDG_RUNTIME_DIR': str(root / 'runtime'),
+         'KH_GITHUB': (root / 'remotes').as_uri(),
+         'KH_GITHUB_API': server.url,
+         'GIT_CONFIG_GLOBAL': os.devnull,
+         'GIT_CONFIG_NOSYSTEM': '1',
+         'GIT_TERMINAL_PROMPT': '0',
+      }
+      with open(root / 'kh.log', 'w', encoding='utf-8') as log:
+         timed(results, 'update (cold)', lambda: run_kh(['--settings', str(settings_path), 'update'], env, log))
+         timed(results, 'mods add', lambda: run_kh(['--settings', str(settings_path), 'mods', 'kh2', 'add', *mod_names], env, log))
+         for _ in range(args.iterations):
+            timed(results, 'update (forced)', lambda: run_kh(['--settings', str(settings_path), 'update', '--force'], env, log))
+            check_build(settings_path, 'kh2')
+            timed(results, 'update (no-op)', lambda: run_kh(['--settings', str(settings_path), 'update'], env, log))
+            timed(results, 'mods list', lambda: run_kh(['--settings', str(settings_path), 'mods', 'kh2', 'list'], env, log))
+
+      os.environ['KH_GITHUB_API'] = server.url
+      os.environ['XDG_CACHE_HOME'] = env['XDG_CACHE_HOME']
+      os.environ['XDG_RUNTIME_DIR'] = env['XDG_RUNTIME_DIR']
+      sys.path.insert(0, str(SCRIPT.parent))
+      import kh
+      for index in range(args.iterations):
+         timed(results, 'download_latest', lambda: kh.download_latest(
+            last_date = None,
+            url = f'{server.url}/repos/OpenKH/OpenKh/releases/tags/latest',
+            asset_filter = lambda x: x['name'] == 'openkh.zip',
+            has_extra_folder = True,
+            extract_filter = None,
+            destination_folder = root / 'download' / str(index)
+         ))
+      for index in range(args.iterations):
+         openkh_files[f'openkh/lib{index:03}.dll'] = os.urandom(16 * 1024)
+         server.add_release('/repos/OpenKH/OpenKh/releases/tags/latest', f'latest{index}', {'openkh.zip': make_zip(openkh_files)})
+         kh.RELEASES.clear()
+         server.bytes_sent = 0
+         timed(results, 'download_latest (delta)', lambda: kh.download_latest(
+            last_date = None,
+            url = f'{server.url}/repos/OpenKH/OpenKh/releases/tags/latest',
+            asset_filter = lambda x: x['name'] == 'openkh.zip',
+            has_extra_folder = True,
+            extract_filter = None,
+            destination_folder = root / 'download' / str(index)
+         ))
+         delta_bytes.append(server.bytes_sent)
+   finally:
+      server.shutdown()
+      if not args.keep:
+         shutil.rmtree(root, ignore_errors=True)
+
+   width = max(len(name) for name in results)
+   print(f'{"Benchmark":<{width}}  {"Runs":>4}  {"Median (s)":>10}  {"Min (s)":>8}  {"Max (s)":>8}')
+   for name, times in results.items():
+      print(f'{name:<{width}}  {len(times):>4}  {statistics.median(times):>10.3f}  {min(times):>8.3f}  {max(times):>8.3f}')
+   if len(delta_bytes) > 0:
+      print(f'Delta updates transferred a median of {statistics.median(delta_bytes)} bytes')
+   if args.output is not None:
+      with open(args.output, 'w', encoding='utf-8') as output:
+         json.dump({name: {'runs': times, 'median': statistics.median(times)} for name, times in results.items()} | {'delta_bytes': delta_bytes}, output, indent=2)
+
+if __name__ == '__main__':
+   main()
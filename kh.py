@@ -1,36 +1,93 @@
 import abc
 import argparse
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import dataclasses
 import datetime
+import getpass
+import hashlib
 import json
 import os
 import pathlib
 import platform
+import select
 import shlex
 import shutil
 import stat
+import struct
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import tomlkit
 import mslex
 import pyunpack
 import requests
+import requests.adapters
 import tomlkit.items
 import typing
 import yaml
-from settings import Games, Kh1525, Kh28, Kh3, Kh3Mods, KhGame, KhMom, LaunchExe, LaunchKh02, LaunchKh1, LaunchKh2, LaunchKh3, LaunchKhBbs, LaunchKhDdd, LaunchKhMom, LaunchKhRecom, Luabackend, Mods, OpenKh, Panacea, Randomizer, Refined, Settings, WineRuntime, get_settings, save_settings
+import zipfile
+import zlib
+from settings import Budget, Games, Kh1525, Kh28, Kh3, Kh3Mods, KhGame, KhMom, LaunchExe, LaunchKh02, LaunchKh1, LaunchKh2, LaunchKh3, LaunchKhBbs, LaunchKhDdd, LaunchKhMom, LaunchKhRecom, Luabackend, Mods, OpenKh, Panacea, Proton, Randomizer, Refined, Settings, Snapshots, WineRuntime, get_settings, save_settings
+
+GITHUB = os.environ.get('KH_GITHUB', 'https://github.com')
+GITHUB_API = os.environ.get('KH_GITHUB_API', 'https://api.github.com')
+MOD_GAME_IDS: dict[str, dict[str, str]] = {
+   'kh15_25': {'kh1': 'KH1', 'kh2': 'KH2', 'bbs': 'BBS', 'Recom': 'ReCoM'},
+   'kh28': {'kh3d': 'KH3D'},
+}
+PHASES: list[str] = ['proton', 'prefix', 'saves', 'openkh', 'luabackend', 'randomizer', 'mods', 'launch']
 
 def main():
    games: list[str] = ['kh1', 'kh2', 'khrecom', 'khbbs', 'khddd']
    parser = argparse.ArgumentParser()
-   parser.add_argument('--settings', type=pathlib.Path, default=pathlib.Path(__file__).parent / 'settings.yaml')
+   parser.add_argument('--settings', type=pathlib.Path, action='append', help='settings file (default: settings.yaml next to this script); update accepts it several times to process several profiles')
+   parser.add_argument('--no-wait', action='store_true', help='fail right away instead of waiting when another kh.py run holds a settings file, wineprefix, tool folder or mod build')
    commands = parser.add_subparsers(dest='command', required=True)
-   commands.add_parser('update')
+   update_command = commands.add_parser('update')
+   update_command.add_argument('--offline', action='store_true', help='skip everything that needs network access')
+   update_command.add_argument('--force', action='store_true', help='update even if nothing changed since the last successful update')
+   phase_selection = update_command.add_mutually_exclusive_group()
+   phase_selection.add_argument('--only', type=parse_phases, help=f'comma-separated phases to run ({",".join(PHASES)})')
+   phase_selection.add_argument('--skip', type=parse_phases, help='comma-separated phases to skip')
+   update_command.add_argument('--jobs', type=int, default=4, help='profiles to update in parallel when several --settings are given')
+   update_command.add_argument('--events', type=str, help='write JSON lines progress events to this file (- for stdout, which moves the usual messages to stderr)')
+   update_command.add_argument('--profile', type=pathlib.Path, help='write a Chrome trace of the run to this file and print a timing summary')
+   shader_cache = commands.add_parser('shadercache', help='show or prune the managed shader caches')
+   shader_cache_action = shader_cache.add_subparsers(dest='action', required=True)
+   shader_cache_action.add_parser('list')
+   shader_cache_prune = shader_cache_action.add_parser('prune')
+   shader_cache_prune.add_argument('--max-size', type=int, help='keep at most this many MiB per game, dropping the least recently used files first')
+   shader_cache_prune.add_argument('--older-than', type=float, help='drop files not used in this many days')
+   storage = commands.add_parser('storage', help='report disk usage of all managed folders')
+   storage.add_argument('--dedup', action='store_true', help='hardlink identical files within the mod collection')
+   saves = commands.add_parser('saves', help='take, list or restore snapshots of the save folders')
+   saves_action = saves.add_subparsers(dest='action', required=True)
+   saves_snapshot = saves_action.add_parser('snapshot')
+   saves_snapshot.add_argument('game', nargs='?', type=str, help='only snapshot this game collection (kh15_25, kh28, kh3, khmom)')
+   saves_list = saves_action.add_parser('list')
+   saves_list.add_argument('game', nargs='?', type=str)
+   saves_restore = saves_action.add_parser('restore')
+   saves_restore.add_argument('game', type=str)
+   saves_restore.add_argument('snapshot', nargs='?', type=str, help='snapshot name (default: latest)')
+   watch = commands.add_parser('watch', help='rebuild OpenKh mods whenever the enabled lists, mod folders or settings change')
+   watch.add_argument('--debounce', type=float, default=1.0, help='seconds to wait for changes to settle before rebuilding')
+   links = commands.add_parser('links', help='check the managed symlinks against the manifest and repair them')
+   links.add_argument('--dry-run', action='store_true', help='only report what would change')
+   commands.add_parser('prewarm', help='start a persistent wineserver for every prefix with a prewarmed launcher')
    mods = commands.add_parser('mods')
    mods.add_argument('game', type=str, choices=games)
    mods_action = mods.add_subparsers(dest='action', required=True)
    mods_action.add_parser('list')
    mods_add = mods_action.add_parser('add')
-   mods_add.add_argument('mod', type=pathlib.PurePath)
+   mods_add.add_argument('mod', type=pathlib.PurePath, nargs='*', help='GitHub user/repo of each mod, in the order they should be enabled')
+   mods_add.add_argument('--file', type=pathlib.Path, help='read user/repo lines (in enabled order, # for comments) from this file')
+   mods_add.add_argument('--jobs', type=int, default=4, help='clone or pull this many mods at once')
    mods_enable = mods_action.add_parser('enable')
    mods_enable.add_argument('mod', type=pathlib.PurePath)
    enable_order = mods_enable.add_subparsers(dest='order', required=True)
@@ -42,8 +99,28 @@ def main():
    enable_below.add_argument('existing', type=pathlib.PurePath)
    mods_disable = mods_action.add_parser('disable')
    mods_disable.add_argument('mod', type=pathlib.PurePath)
+   mods_profile = mods_action.add_parser('profile', help='save, load, list or delete named sets of enabled mods')
+   profile_action = mods_profile.add_subparsers(dest='profile_action', required=True)
+   profile_action.add_parser('list')
+   profile_save = profile_action.add_parser('save', help='save the enabled mods as a profile')
+   profile_save.add_argument('name', type=str)
+   profile_load = profile_action.add_parser('load', help='replace the enabled mods with a profile')
+   profile_load.add_argument('name', type=str)
+   profile_delete = profile_action.add_parser('delete')
+   profile_delete.add_argument('name', type=str)
    args = parser.parse_args()
-   settings_path: pathlib.Path = args.settings
+   if args.no_wait:
+      global LOCK_WAIT
+      LOCK_WAIT = False
+   if getattr(args, 'events', None) is not None:
+      open_events(args.events)
+   settings_paths: list[pathlib.Path] = args.settings if args.settings is not None else [pathlib.Path(__file__).parent / 'settings.yaml']
+   if len(settings_paths) > 1:
+      if args.command != 'update':
+         parser.error('only update accepts several --settings files')
+      update_profiles(settings_paths, force=args.force, offline=args.offline, phases=selected_phases(args), jobs=args.jobs, profile=args.profile)
+      return
+   settings_path = settings_paths[0]
    if not settings_path.exists():
       initial_run(settings_path)
       return
@@ -54,97 +131,390 @@ def main():
             print('OpenKh not configured in settings')
             return
          handle_mods(args, openkh, settings, settings_path)
+      case 'shadercache':
+         match args.action:
+            case 'list':
+               list_shader_caches(settings)
+            case 'prune':
+               prune_shader_caches(settings, None if args.max_size is None else args.max_size * 1024 * 1024, args.older_than)
+      case 'storage':
+         report_storage(settings, dedup=args.dedup)
+      case 'saves':
+         match args.action:
+            case 'snapshot':
+               snapshot_all_saves(settings, args.game)
+            case 'list':
+               list_save_snapshots(settings, args.game)
+            case 'restore':
+               restore_save_snapshot(settings, args.game, args.snapshot)
+      case 'watch':
+         watch_mods(settings, settings_path, args.debounce)
+      case 'links':
+         check_links(settings_path, args.dry_run)
+      case 'prewarm':
+         prewarm_prefixes(get_environment(settings), settings)
       case 'update':
-         update(settings, args.settings)
+         try:
+            with PROFILER.span('update'):
+               update(settings, settings_path, force=args.force, offline=args.offline, phases=selected_phases(args))
+         finally:
+            if args.profile is not None:
+               PROFILER.write_trace(args.profile)
+               PROFILER.print_summary()
 
 def handle_mods(args: argparse.Namespace, openkh: OpenKh, settings: Settings, settings_path: pathlib.Path):
-   symlinks = Symlinks()
+   symlinks = Symlinks(links_path(settings_path))
    environment = get_environment(settings)
-   openkh_settings = check_openkh(openkh, symlinks, environment, settings, settings_path, check_updates=False)
+   provision_prefixes(environment, settings)
+   openkh_settings = check_openkh(openkh, symlinks, environment, settings, settings_path, check_updates=False, offline=False)
    match args.action:
       case 'list':
          list_mods(args.game, environment, settings, openkh, openkh_settings)
       case 'add':
-         download_mod(args.game, args.mod, environment, settings, openkh, openkh_settings)
+         requested: list[pathlib.PurePath] = list(args.mod)
+         if args.file is not None:
+            with open(args.file, 'r', encoding='utf-8') as mods_file:
+               requested.extend(pathlib.PurePath(line.strip()) for line in mods_file if line.strip() != '' and not line.strip().startswith('#'))
+         if len(requested) == 0:
+            print('No mods given')
+         else:
+            download_mods(args.game, requested, args.jobs, environment, settings, openkh, openkh_settings)
       case 'enable':
          order: ModOrder = args.order if args.order in ['top', 'bottom'] else (args.order, args.existing)
          enable_mod(args.game, args.mod, order, environment, settings, openkh, openkh_settings)
       case 'disable':
          disable_mod(args.game, args.mod, environment, settings, openkh, openkh_settings)
+      case 'profile':
+         match args.profile_action:
+            case 'list':
+               list_mod_profiles(args.game, openkh)
+            case 'save':
+               save_mod_profile(args.game, args.name, openkh)
+            case 'load':
+               load_mod_profile(args.game, args.name, environment, settings, openkh, openkh_settings)
+            case 'delete':
+               delete_mod_profile(args.game, args.name, openkh)
    symlinks.commit()
 
-def update(settings: Settings, settings_path: pathlib.Path):
-   print('Updating installations')
+def open_events(target: str):
+   if target == '-':
+      sys.stdout.flush()
+      events_fd = os.dup(1)
+      os.dup2(2, 1)
+      EVENTS.open(os.fdopen(events_fd, 'w', encoding='utf-8'))
+   else:
+      path = pathlib.Path(target)
+      path.parent.mkdir(parents=True, exist_ok=True)
+      EVENTS.open(open(path, 'w', encoding='utf-8'))
+
+def selected_phases(args: argparse.Namespace) -> set[str] | None:
+   if args.only is not None:
+      return args.only
+   if args.skip is not None:
+      return set(PHASES) - args.skip
+   return None
 
-   symlinks = Symlinks()
-   environment = get_environment(settings)
+def profile_paths(settings: Settings) -> list[pathlib.Path]:
+   paths: list[pathlib.Path] = []
+   for game in settings.games.get_all():
+      paths.extend(path for path in [game.folder, game.wineprefix, game.saves, game.workspace] if path is not None)
+   paths.extend(mod.folder for mod in [settings.mods.openkh, settings.mods.luabackend, settings.mods.refined, settings.mods.randomizer, settings.mods.kh3] if mod is not None)
+   return [path.resolve() for path in paths]
+
+def group_profiles(profiles: list[tuple[pathlib.Path, Settings]]) -> list[list[tuple[pathlib.Path, Settings]]]:
+   groups: list[tuple[list[pathlib.Path], list[tuple[pathlib.Path, Settings]]]] = []
+   for settings_path, settings in profiles:
+      paths = profile_paths(settings)
+      overlapping = [group for group in groups if any(a == b or a.is_relative_to(b) or b.is_relative_to(a) for a in paths for b in group[0])]
+      merged: tuple[list[pathlib.Path], list[tuple[pathlib.Path, Settings]]] = (paths, [])
+      for group in overlapping:
+         groups.remove(group)
+         merged[0].extend(group[0])
+         merged[1].extend(group[1])
+      merged[1].append((settings_path, settings))
+      groups.append(merged)
+   return [members for _paths, members in groups]
+
+def update_profiles(settings_paths: list[pathlib.Path], force: bool, offline: bool, phases: set[str] | None, jobs: int, profile: pathlib.Path | None):
+   global GIT_MIRRORS
+   GIT_MIRRORS = True
+   failures: dict[pathlib.Path, BaseException] = {}
+   profiles: list[tuple[pathlib.Path, Settings]] = []
+   for settings_path in settings_paths:
+      try:
+         profiles.append((settings_path, get_settings(settings_path)))
+      except Exception as error:
+         print(f'Can\'t load \'{settings_path}\': {error}')
+         failures[settings_path] = error
+   def update_group(group: list[tuple[pathlib.Path, Settings]]):
+      for settings_path, settings in group:
+         print(f'Updating profile \'{settings_path}\'')
+         try:
+            with PROFILER.span(str(settings_path)):
+               update(settings, settings_path, force=force, offline=offline, phases=phases)
+         except Exception as error:
+            print(f'Update of \'{settings_path}\' failed: {error}')
+            failures[settings_path] = error
+   try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+         list(executor.map(update_group, group_profiles(profiles)))
+   finally:
+      if profile is not None:
+         PROFILER.write_trace(profile)
+         PROFILER.print_summary()
+   print(f'Updated {len(settings_paths) - len(failures)} of {len(settings_paths)} profiles')
+   for settings_path, error in failures.items():
+      print(f'   {settings_path}: {error}')
+   if len(failures) > 0:
+      sys.exit(1)
+
+def parse_phases(value: str) -> set[str]:
+   phases = {phase.strip() for phase in value.split(',') if phase.strip() != ''}
+   unknown = phases - set(PHASES)
+   if len(unknown) > 0:
+      raise argparse.ArgumentTypeError(f'unknown phases {", ".join(sorted(unknown))} (choose from {", ".join(PHASES)})')
+   return phases
+
+def update(settings: Settings, settings_path: pathlib.Path, force: bool, offline: bool, phases: set[str] | None):
+   state = load_state(settings_path)
+   if phases is None and not force and is_up_to_date(settings, settings_path, state, offline):
+      print('Nothing changed since the last update (use --force to update anyway)')
+      return
+   selected = set(PHASES) if phases is None else phases
 
-   check_saves(symlinks, environment, settings)
+   print('Updating installations')
 
-   if (game := settings.games.kh15_25) is not None:
-      folder = game.get_workspace()
-      symlinks.remove(folder / 'reFined.cfg')
-      if (refined := settings.mods.refined) is not None:
-         symlinks.make(folder / 'reFined.cfg', refined.settings, is_dir=False)
+   symlinks = Symlinks(links_path(settings_path))
+   with PROFILER.span('environment'):
+      environment = get_environment(settings)
+   scheduler = Scheduler(resource_budget(settings), settings.budget.workers if settings.budget is not None else Budget().workers)
 
-   for game in settings.games.get_classic():
-      folder = game.get_workspace()
-      symlinks.remove(game.folder / 'version.dll')
-      symlinks.remove(game.folder / 'DINPUT8.dll')
-      symlinks.remove(game.folder / 'DBGHELP.dll')
-      symlinks.remove(folder / 'LuaBackend.dll')
-      symlinks.remove(folder / 'LuaBackend.toml')
-      symlinks.remove(folder / 'panacea_settings.txt')
-      symlinks.remove(folder / 'dependencies/avcodec-vgmstream-59.dll')
-      symlinks.remove(folder / 'dependencies/avformat-vgmstream-59.dll')
-      symlinks.remove(folder / 'dependencies/avutil-vgmstream-57.dll')
-      symlinks.remove(folder / 'dependencies/bass.dll')
-      symlinks.remove(folder / 'dependencies/bass_vgmstream.dll')
-      symlinks.remove(folder / 'dependencies/libatrac9.dll')
-      symlinks.remove(folder / 'dependencies/libcelt-0061.dll')
-      symlinks.remove(folder / 'dependencies/libcelt-0110.dll')
-      symlinks.remove(folder / 'dependencies/libg719_decode.dll')
-      symlinks.remove(folder / 'dependencies/libmpg123-0.dll')
-      symlinks.remove(folder / 'dependencies/libspeex-1.dll')
-      symlinks.remove(folder / 'dependencies/libvorbis.dll')
-      symlinks.remove(folder / 'dependencies/swresample-vgmstream-4.dll')
-      if settings.mods.openkh is None or settings.mods.openkh.panacea is not None:
-         restore_folder(game.folder / 'Image', game.folder / 'Image-BACKUP')
-
-   if (game := settings.games.kh3) is not None:
-      mods = game.folder / 'KINGDOM HEARTS III/Content/Paks/~mods'
-      symlinks.remove(mods)
-      if (kh3 := settings.mods.kh3) is not None:
-         symlinks.make(mods, kh3.folder, is_dir=True)
+   with PROFILER.span('cleanup'):
+      for game in settings.games.get_classic():
+         folder = game.get_workspace()
+         dbghelp_phase = 'openkh' if settings.mods.openkh is not None else 'luabackend'
+         if dbghelp_phase in selected:
+            symlinks.remove(game.folder / 'DBGHELP.dll')
+         if 'openkh' in selected:
+            symlinks.remove(game.folder / 'version.dll')
+            symlinks.remove(folder / 'panacea_settings.txt')
+            symlinks.remove(folder / 'dependencies/avcodec-vgmstream-59.dll')
+            symlinks.remove(folder / 'dependencies/avformat-vgmstream-59.dll')
+            symlinks.remove(folder / 'dependencies/avutil-vgmstream-57.dll')
+            symlinks.remove(folder / 'dependencies/bass.dll')
+            symlinks.remove(folder / 'dependencies/bass_vgmstream.dll')
+            symlinks.remove(folder / 'dependencies/libatrac9.dll')
+            symlinks.remove(folder / 'dependencies/libcelt-0061.dll')
+            symlinks.remove(folder / 'dependencies/libcelt-0110.dll')
+            symlinks.remove(folder / 'dependencies/libg719_decode.dll')
+            symlinks.remove(folder / 'dependencies/libmpg123-0.dll')
+            symlinks.remove(folder / 'dependencies/libspeex-1.dll')
+            symlinks.remove(folder / 'dependencies/libvorbis.dll')
+            symlinks.remove(folder / 'dependencies/swresample-vgmstream-4.dll')
+         if 'luabackend' in selected:
+            symlinks.remove(game.folder / 'DINPUT8.dll')
+            symlinks.remove(folder / 'LuaBackend.dll')
+            symlinks.remove(folder / 'LuaBackend.toml')
+
+   if (proton := settings.proton) is not None and 'proton' in selected and uses_umu(settings) and platform.system() == 'Linux':
+      scheduler.add('proton', lambda: check_proton(proton, settings, offline))
+
+   needs_prefix = len(selected - {'proton', 'prefix', 'randomizer'}) > 0
+   if 'prefix' in selected or (needs_prefix and not prefixes_ready(environment, settings)):
+      scheduler.add('prefix', lambda: provision_prefixes(environment, settings), after=['proton'], cpus=1, memory=512)
+
+   if 'saves' in selected:
+      def saves():
+         if settings.snapshots is not None and settings.snapshots.on_update:
+            snapshot_all_saves(settings, None)
+         check_saves(symlinks, environment, settings)
+      scheduler.add('saves', saves, after=['prefix'], cpus=1)
+
+   if 'mods' in selected:
+      def restore():
+         if (game := settings.games.kh15_25) is not None:
+            folder = game.get_workspace()
+            symlinks.remove(folder / 'reFined.cfg')
+            if (refined := settings.mods.refined) is not None:
+               symlinks.make(folder / 'reFined.cfg', refined.settings, is_dir=False)
+
+         for game in settings.games.get_classic():
+            if settings.mods.openkh is None or settings.mods.openkh.panacea is not None:
+               restore_folder(game.folder / 'Image', game.folder / 'Image-BACKUP')
 
-   if (openkh := settings.mods.openkh) is not None:
-      openkh_settings = check_openkh(openkh, symlinks, environment, settings, settings_path, check_updates=True)
-   else:
-      openkh_settings = None
+         if (game := settings.games.kh3) is not None:
+            mods = game.folder / 'KINGDOM HEARTS III/Content/Paks/~mods'
+            symlinks.remove(mods)
+            if (kh3 := settings.mods.kh3) is not None:
+               symlinks.make(mods, kh3.folder, is_dir=True)
+      scheduler.add('restore', restore, cpus=1)
+
+   results: dict[str, typing.Any] = {}
+   if (openkh := settings.mods.openkh) is not None and len(selected & {'openkh', 'luabackend', 'mods'}) > 0:
+      check_updates = 'openkh' in selected
+      scheduler.add('openkh download', lambda: fetch_openkh(openkh, settings, settings_path, check_updates=check_updates, offline=offline))
+      def configure_openkh():
+         results['openkh'] = check_openkh(openkh, symlinks, environment, settings, settings_path, check_updates=check_updates, offline=offline, fetch=False)
+      scheduler.add('openkh', configure_openkh, after=['openkh download', 'prefix'])
+
+   if (luabackend := settings.mods.luabackend) is not None and 'luabackend' in selected:
+      scheduler.add('luabackend download', lambda: fetch_luabackend(luabackend, settings, settings_path, offline))
+      scheduler.add('luabackend', lambda: check_luabackend(luabackend, results.get('openkh'), symlinks, environment, settings, settings_path, offline, fetch=False), after=['luabackend download', 'openkh', 'prefix'])
+
+   if (randomizer := settings.mods.randomizer) is not None and 'randomizer' in selected:
+      scheduler.add('randomizer', lambda: check_randomizer(randomizer, settings, settings_path, offline))
+
+   if (openkh := settings.mods.openkh) is not None and 'mods' in selected:
+      scheduler.add('mods', lambda: mod_games(openkh, results['openkh'], environment, settings, settings_path, offline), after=['openkh', 'restore', 'prefix'])
+
+   if 'launch' in selected:
+      def launch():
+         if (game := settings.games.kh15_25) is not None:
+            make_launch(game, game.kh1, environment, settings, settings_path, lua=True, openkh=True, refined=False, kh3=False)
+            make_launch(game, game.kh2, environment, settings, settings_path, lua=True, openkh=True, refined=True, kh3=False)
+            make_launch(game, game.khbbs, environment, settings, settings_path, lua=True, openkh=True, refined=False, kh3=False)
+            make_launch(game, game.khrecom, environment, settings, settings_path, lua=True, openkh=True, refined=False, kh3=False)
+         if (game := settings.games.kh28) is not None:
+            make_launch(game, game.khddd, environment, settings, settings_path, lua=True, openkh=True, refined=False, kh3=False)
+            make_launch(game, game.kh02, environment, settings, settings_path, lua=False, openkh=False, refined=False, kh3=False)
+         if (game := settings.games.kh3) is not None:
+            make_launch(game, game.kh3, environment, settings, settings_path, lua=False, openkh=False, refined=False, kh3=True)
+         if (game := settings.games.khmom) is not None:
+            make_launch(game, game.khmom, environment, settings, settings_path, lua=False, openkh=False, refined=False, kh3=False)
+         prewarm_prefixes(environment, settings)
+      scheduler.add('launch', launch, after=['prefix', 'proton'])
+
+   completed = False
+   try:
+      scheduler.run()
+      completed = phases is None
+   finally:
+      with PROFILER.span('symlinks'):
+         symlinks.commit(complete=completed)
+
+   if phases is None:
+      state['fingerprint'] = environment_fingerprint(settings, settings_path)
+      save_state(settings_path, state)
+
+def update_due(update: bool | datetime.datetime, check_interval: float | None, last_check: datetime.datetime | None) -> bool:
+   if update == False:
+      return False
+   if check_interval is None or last_check is None:
+      return True
+   return now() - last_check >= datetime.timedelta(hours=check_interval)
 
+def periodic_check_due(settings: Settings) -> bool:
+   if (openkh := settings.mods.openkh) is not None:
+      if update_due(openkh.update, openkh.check_interval, openkh.last_check):
+         return True
+      if update_due(openkh.update_mods, openkh.mods_check_interval, openkh.mods_last_check):
+         return True
    if (luabackend := settings.mods.luabackend) is not None:
-      check_luabackend(luabackend, openkh_settings, symlinks, environment, settings, settings_path)
-
+      if update_due(luabackend.update, luabackend.check_interval, luabackend.last_check):
+         return True
    if (randomizer := settings.mods.randomizer) is not None:
-      check_randomizer(randomizer, settings, settings_path)
+      if update_due(randomizer.update, randomizer.check_interval, randomizer.last_check):
+         return True
+   return False
 
-   if (openkh := settings.mods.openkh) is not None and openkh_settings is not None:
-      mod_games(openkh, openkh_settings, environment, settings, settings_path)
+def now() -> datetime.datetime:
+   return datetime.datetime.now(datetime.timezone.utc)
 
-   if (game := settings.games.kh15_25) is not None:
-      make_launch(game, game.kh1, environment, settings, lua=True, openkh=True, refined=False, kh3=False)
-      make_launch(game, game.kh2, environment, settings, lua=True, openkh=True, refined=True, kh3=False)
-      make_launch(game, game.khbbs, environment, settings, lua=True, openkh=True, refined=False, kh3=False)
-      make_launch(game, game.khrecom, environment, settings, lua=True, openkh=True, refined=False, kh3=False)
-   if (game := settings.games.kh28) is not None:
-      make_launch(game, game.khddd, environment, settings, lua=True, openkh=True, refined=False, kh3=False)
-      make_launch(game, game.kh02, environment, settings, lua=False, openkh=False, refined=False, kh3=False)
-   if (game := settings.games.kh3) is not None:
-      make_launch(game, game.kh3, environment, settings, lua=False, openkh=False, refined=False, kh3=True)
-   if (game := settings.games.khmom) is not None:
-      make_launch(game, game.khmom, environment, settings, lua=False, openkh=False, refined=False, kh3=False)
+def state_path(settings_path: pathlib.Path) -> pathlib.Path:
+   return settings_path.with_suffix('.state.json')
 
-   symlinks.commit()
+def load_state(settings_path: pathlib.Path) -> dict[str, typing.Any]:
+   path = state_path(settings_path)
+   if path.exists():
+      try:
+         with open(path, 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+      except json.JSONDecodeError:
+         print(f'Ignoring unreadable state file \'{path}\'')
+   return {}
+
+def save_state(settings_path: pathlib.Path, state: dict[str, typing.Any]):
+   path = state_path(settings_path)
+   with settings_lock(path):
+      temp_path = path.with_name(path.name + '.tmp')
+      with open(temp_path, 'w', encoding='utf-8') as state_file:
+         json.dump(state, state_file, indent=1)
+      temp_path.replace(path)
+
+def git_head(folder: pathlib.Path) -> str | None:
+   git_dir = folder / '.git'
+   try:
+      if git_dir.is_file():
+         git_dir = folder / git_dir.read_text(encoding='utf-8').removeprefix('gitdir:').strip()
+      head = (git_dir / 'HEAD').read_text(encoding='utf-8').strip()
+   except OSError:
+      return None
+   if not head.startswith('ref: '):
+      return head
+   ref = head.removeprefix('ref: ')
+   try:
+      return (git_dir / ref).read_text(encoding='utf-8').strip()
+   except OSError:
+      pass
+   try:
+      with open(git_dir / 'packed-refs', 'r', encoding='utf-8') as packed_refs:
+         for line in packed_refs:
+            if line.rstrip('\n').endswith(' ' + ref):
+               return line.split(' ', 1)[0]
+   except OSError:
+      pass
+   return head
+
+def environment_fingerprint(settings: Settings, settings_path: pathlib.Path) -> str:
+   digest = hashlib.sha256()
+   def add(*parts: typing.Any):
+      digest.update(repr(parts).encode('utf-8'))
+   def add_file(path: pathlib.Path):
+      try:
+         stats = path.stat()
+         add(str(path), stats.st_size, stats.st_mtime_ns)
+      except OSError:
+         add(str(path), None)
+   add(settings_path.read_bytes())
+   add_file(pathlib.Path(__file__))
+   add_file(pathlib.Path(__file__).with_name('settings.py'))
+   if platform.system() == 'Linux':
+      for tool in ['wine', 'umu-run', 'winetricks']:
+         if (found := shutil.which(tool)) is not None:
+            add_file(pathlib.Path(found))
+      if (proton := settings.proton) is not None:
+         add_file(proton_folder(proton, settings) / 'proton')
+   if (openkh := settings.mods.openkh) is not None:
+      mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
+      for text, gameid in {'KH1': 'kh1', 'KH2': 'kh2', 'BBS': 'bbs', 'ReCoM': 'Recom', 'KH3D': 'kh3d'}.items():
+         enabled_path = openkh.folder / f'mods-{text}.txt'
+         if not enabled_path.exists():
+            continue
+         enabled = enabled_path.read_text(encoding='utf-8')
+         add(text, enabled)
+         for line in enabled.splitlines():
+            add(line, git_head(mods / gameid / line))
+   return digest.hexdigest()
+
+def is_up_to_date(settings: Settings, settings_path: pathlib.Path, state: dict[str, typing.Any], offline: bool) -> bool:
+   if 'fingerprint' not in state or state['fingerprint'] != environment_fingerprint(settings, settings_path):
+      return False
+   if not offline and periodic_check_due(settings):
+      return False
+   for path, (target, _is_dir) in load_links(links_path(settings_path)).items():
+      try:
+         if pathlib.Path(os.readlink(path)) != target:
+            return False
+      except OSError:
+         return False
+   for game in settings.games.get_all():
+      for launch in game.get_exes():
+         if launch.launch is not None and not launch.launch.exists():
+            return False
+   for tool in [settings.mods.openkh, settings.mods.luabackend, settings.mods.randomizer]:
+      if tool is not None and len(changed_install_files(tool.folder)[0]) > 0:
+         return False
+   return True
 
 def initial_run(settings_path: pathlib.Path) -> Settings:
    print('First-time run, welcome!')
@@ -256,8 +626,9 @@ def initial_run(settings_path: pathlib.Path) -> Settings:
             folder = extra_folder / 'mods/kh3'
          ),
       ),
+      shader_cache = extra_folder / 'shadercache' if is_linux else None,
    )
-   save_settings(settings, settings_path)
+   save_settings_locked(settings, settings_path)
    return settings
 
 def yes_no():
@@ -328,6 +699,372 @@ def restore_folder(source: pathlib.Path, backup: pathlib.Path):
          shutil.copyfile(file, source / relative_name)
       shutil.rmtree(backup)
 
+class EventLog:
+   def __init__(self):
+      self.file: typing.TextIO | None = None
+      self.origin = time.perf_counter()
+      self.lock = threading.Lock()
+
+   def open(self, file: typing.TextIO):
+      self.file = file
+
+   def emit(self, event: str, **fields: typing.Any):
+      if self.file is None:
+         return
+      record = {'event': event, 'time': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'elapsed': round(time.perf_counter() - self.origin, 3)} | fields
+      with self.lock:
+         self.file.write(json.dumps(record, default=str) + '\n')
+         self.file.flush()
+
+EVENTS = EventLog()
+
+class Span:
+   def __init__(self, name: str, category: str, parents: list['Span']):
+      self.name = name
+      self.category = category
+      self.parents = parents
+      self.thread = threading.get_ident()
+      self.begin = time.perf_counter()
+      self.end: float | None = None
+      self.subprocess_time = 0.0
+      self.args: dict[str, typing.Any] = {}
+
+   def path(self) -> str:
+      return '/'.join([*(parent.name for parent in self.parents if parent.category == 'phase'), self.name])
+
+class Profiler:
+   def __init__(self):
+      self.origin = time.perf_counter()
+      self.spans: list[Span] = []
+      self.local = threading.local()
+      self.lock = threading.Lock()
+
+   def stack(self) -> list[Span]:
+      if not hasattr(self.local, 'stack'):
+         self.local.stack = []
+      return self.local.stack
+
+   @contextlib.contextmanager
+   def span(self, name: str, category: str = 'phase') -> typing.Iterator[Span]:
+      stack = self.stack()
+      current = Span(name, category, list(stack))
+      with self.lock:
+         self.spans.append(current)
+      stack.append(current)
+      if category == 'phase':
+         EVENTS.emit('phase_start', phase=current.path())
+      try:
+         yield current
+      finally:
+         stack.pop()
+         current.end = time.perf_counter()
+         if category == 'phase':
+            EVENTS.emit('phase_end', phase=current.path(), seconds=round(current.end - current.begin, 3), subprocess_seconds=round(current.subprocess_time, 3), failed=sys.exc_info()[0] is not None)
+         if category == 'subprocess':
+            for parent in current.parents:
+               parent.subprocess_time += current.end - current.begin
+
+   def write_trace(self, path: pathlib.Path):
+      events: list[dict[str, typing.Any]] = []
+      for span in self.spans:
+         end = span.end if span.end is not None else time.perf_counter()
+         events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': (span.begin - self.origin) * 1_000_000,
+            'dur': (end - span.begin) * 1_000_000,
+            'pid': os.getpid(),
+            'tid': span.thread,
+            'args': span.args | {'subprocess_ms': round(span.subprocess_time * 1000, 3)},
+         })
+      path.parent.mkdir(parents=True, exist_ok=True)
+      with open(path, 'w', encoding='utf-8') as trace_file:
+         json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+      print(f'Wrote profile trace to \'{path}\'')
+
+   def print_summary(self):
+      totals: dict[str, tuple[int, int, float, float]] = {}
+      for span in self.spans:
+         if span.category != 'phase' or span.end is None:
+            continue
+         path = span.path()
+         count, depth, wall, sub = totals.get(path, (0, len(path.split('/')) - 1, 0.0, 0.0))
+         totals[path] = (count + 1, depth, wall + span.end - span.begin, sub + span.subprocess_time)
+      if len(totals) == 0:
+         return
+      width = max(len('Phase'), *(len('  ' * depth + path.split('/')[-1]) for path, (_count, depth, _wall, _sub) in totals.items()))
+      print(f'{"Phase":<{width}}  {"Count":>5}  {"Wall (s)":>9}  {"Subprocess (s)":>14}')
+      for path, (count, depth, wall, sub) in totals.items():
+         name = '  ' * depth + path.split('/')[-1]
+         print(f'{name:<{width}}  {count:>5}  {wall:>9.3f}  {sub:>14.3f}')
+
+PROFILER = Profiler()
+
+class ResourceBudget:
+   def __init__(self, cpus: int, memory: int | None):
+      self.cpus = cpus
+      self.memory = memory
+      self.used_cpus = 0
+      self.used_memory = 0
+      self.holders = 0
+      self.condition = threading.Condition()
+
+   def fits(self, cpus: int, memory: int) -> bool:
+      if self.holders == 0:
+         return True
+      return self.used_cpus + cpus <= self.cpus and (self.memory is None or self.used_memory + memory <= self.memory)
+
+   def take(self, cpus: int, memory: int):
+      self.used_cpus += cpus
+      self.used_memory += memory
+      self.holders += 1
+
+   def try_acquire(self, cpus: int, memory: int) -> bool:
+      if cpus == 0 and memory == 0:
+         return True
+      with self.condition:
+         if not self.fits(cpus, memory):
+            return False
+         self.take(cpus, memory)
+         return True
+
+   def acquire(self, cpus: int, memory: int):
+      if cpus == 0 and memory == 0:
+         return
+      with self.condition:
+         self.condition.wait_for(lambda: self.fits(cpus, memory))
+         self.take(cpus, memory)
+
+   def release(self, cpus: int, memory: int):
+      if cpus == 0 and memory == 0:
+         return
+      with self.condition:
+         self.used_cpus -= cpus
+         self.used_memory -= memory
+         self.holders -= 1
+         self.condition.notify_all()
+
+   @contextlib.contextmanager
+   def use(self, cpus: int, memory: int) -> typing.Iterator[None]:
+      self.acquire(cpus, memory)
+      try:
+         yield
+      finally:
+         self.release(cpus, memory)
+
+RESOURCE_BUDGET: ResourceBudget | None = None
+
+def available_memory() -> int | None:
+   try:
+      with open('/proc/meminfo', 'r', encoding='utf-8') as meminfo:
+         for line in meminfo:
+            if line.startswith('MemAvailable:'):
+               return int(line.split()[1]) // 1024
+   except OSError:
+      pass
+   return None
+
+def resource_budget(settings: Settings) -> ResourceBudget:
+   global RESOURCE_BUDGET
+   if RESOURCE_BUDGET is None:
+      budget = settings.budget if settings.budget is not None else Budget()
+      cpus = budget.cpus if budget.cpus is not None else os.cpu_count() or 1
+      memory = budget.memory if budget.memory is not None else available_memory()
+      RESOURCE_BUDGET = ResourceBudget(cpus, memory)
+   return RESOURCE_BUDGET
+
+class Scheduler:
+   def __init__(self, budget: ResourceBudget, workers: int):
+      self.budget = budget
+      self.workers = max(workers, 1)
+      self.tasks: dict[str, tuple[typing.Callable[[], typing.Any], list[str], int, int]] = {}
+
+   def add(self, name: str, action: typing.Callable[[], typing.Any], after: list[str] | None = None, cpus: int = 0, memory: int = 0):
+      self.tasks[name] = (action, after or [], cpus, memory)
+
+   def execute(self, name: str, action: typing.Callable[[], typing.Any], parents: list[Span]):
+      PROFILER.local.stack = list(parents)
+      with PROFILER.span(name):
+         action()
+
+   def run(self):
+      parents = list(PROFILER.stack())
+      pending = dict(self.tasks)
+      done: set[str] = set()
+      failed: dict[str, BaseException] = {}
+      running: dict[concurrent.futures.Future, tuple[str, int, int]] = {}
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+         while len(pending) > 0 or len(running) > 0:
+            for name, (action, after, cpus, memory) in list(pending.items()):
+               dependencies = [dependency for dependency in after if dependency in self.tasks]
+               if any(dependency in failed for dependency in dependencies):
+                  print(f'Skipping {name} because a task it needs failed')
+                  EVENTS.emit('task_skipped', task=name)
+                  failed[name] = failed[next(dependency for dependency in dependencies if dependency in failed)]
+                  del pending[name]
+               elif all(dependency in done for dependency in dependencies) and len(running) < self.workers and self.budget.try_acquire(cpus, memory):
+                  del pending[name]
+                  running[executor.submit(self.execute, name, action, parents)] = (name, cpus, memory)
+            if len(running) == 0:
+               if len(pending) == 0:
+                  break
+               ready = [(cpus, memory) for action, after, cpus, memory in pending.values() if all(dependency in done for dependency in after if dependency in self.tasks)]
+               if len(ready) == 0:
+                  raise ValueError(f'Tasks {", ".join(pending)} can never run, their dependencies form a cycle')
+               with self.budget.condition:
+                  self.budget.condition.wait_for(lambda: any(self.budget.fits(cpus, memory) for cpus, memory in ready))
+               continue
+            finished, _running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+               name, cpus, memory = running.pop(future)
+               self.budget.release(cpus, memory)
+               if (error := future.exception()) is not None:
+                  print(f'Task {name} failed: {error}')
+                  failed[name] = error
+               else:
+                  done.add(name)
+      if len(failed) > 0:
+         raise next(iter(failed.values()))
+
+LOCK_WAIT = True
+
+class ResourceLock:
+   def __init__(self, path: pathlib.Path, description: str):
+      self.path = path
+      self.description = description
+      self.condition = threading.Condition()
+      self.owner: int | None = None
+      self.depth = 0
+      self.shared = 0
+      self.file: typing.BinaryIO | None = None
+      self.file_shared = False
+
+   def acquire(self, shared: bool):
+      me = threading.get_ident()
+      with self.condition:
+         if self.owner == me:
+            self.depth += 1
+            return
+         self.condition.wait_for(lambda: self.owner is None and (shared or self.shared == 0))
+         if self.file is None:
+            self.file = self.open_locked(shared)
+            self.file_shared = shared
+         if shared:
+            self.shared += 1
+         else:
+            self.owner = me
+            self.depth = 1
+
+   def release(self):
+      with self.condition:
+         if self.owner == threading.get_ident():
+            self.depth -= 1
+            if self.depth > 0:
+               return
+            self.owner = None
+         else:
+            self.shared -= 1
+         if self.owner is None and self.shared == 0 and self.file is not None:
+            unlock_file(self.file, self.file_shared)
+            self.file = None
+         self.condition.notify_all()
+
+   def open_locked(self, shared: bool) -> typing.BinaryIO:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      file = open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+b')
+      if not lock_file(file, shared, blocking=False):
+         try:
+            holder = file.read().decode('utf-8').strip()
+         except OSError:
+            holder = ''
+         holder = f' (pid {holder})' if holder != '' else ''
+         if not LOCK_WAIT:
+            file.close()
+            raise ValueError(f'{self.description} is in use by another kh.py run{holder}, try again when it finishes')
+         print(f'Waiting for {self.description}, it is in use by another kh.py run{holder}')
+         EVENTS.emit('lock_wait', lock=self.description)
+         lock_file(file, shared, blocking=True)
+      if not shared:
+         file.seek(0)
+         file.truncate()
+         file.write(f'{os.getpid()}: {shlex.join(sys.argv)}'.encode('utf-8'))
+         file.flush()
+      return file
+
+def lock_file(file: typing.BinaryIO, shared: bool, blocking: bool) -> bool:
+   if platform.system() == 'Windows':
+      import msvcrt
+      while True:
+         file.seek(0)
+         try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+         except OSError:
+            if not blocking:
+               return False
+            time.sleep(0.5)
+   import fcntl
+   try:
+      fcntl.flock(file.fileno(), (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+      return True
+   except BlockingIOError:
+      return False
+
+def unlock_file(file: typing.BinaryIO, shared: bool):
+   if not shared:
+      file.seek(0)
+      file.truncate()
+   if platform.system() == 'Windows':
+      import msvcrt
+      file.seek(0)
+      msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+   file.close()
+
+RESOURCE_LOCKS: dict[str, ResourceLock] = {}
+RESOURCE_LOCKS_LOCK = threading.Lock()
+
+def lock_folder() -> pathlib.Path:
+   return pathlib.Path(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())) / f'kingdom-hearts-linux-{getpass.getuser()}'
+
+@contextlib.contextmanager
+def resource_lock(kind: str, path: pathlib.Path, description: str, shared: bool = False) -> typing.Iterator[None]:
+   key = f'{kind}-{hashlib.sha1(str(path.resolve()).encode("utf-8")).hexdigest()[:16]}'
+   with RESOURCE_LOCKS_LOCK:
+      if key not in RESOURCE_LOCKS:
+         RESOURCE_LOCKS[key] = ResourceLock(lock_folder() / f'{key}.lock', description)
+      lock = RESOURCE_LOCKS[key]
+   lock.acquire(shared)
+   try:
+      yield
+   finally:
+      lock.release()
+
+def settings_lock(path: pathlib.Path) -> typing.ContextManager[None]:
+   return resource_lock('settings', path, f'\'{path.name}\'')
+
+def prefix_lock(prefix: pathlib.Path) -> typing.ContextManager[None]:
+   return resource_lock('prefix', prefix, f'the wineprefix \'{prefix}\'')
+
+def build_lock(enabled_path: pathlib.Path) -> typing.ContextManager[None]:
+   return resource_lock('build', enabled_path, f'the mod build for \'{enabled_path.name}\'')
+
+def game_lock(game: KhGame) -> typing.ContextManager[None]:
+   return resource_lock('game', game.folder, f'the game folder \'{game.folder}\'')
+
+def tool_lock(folder: pathlib.Path, shared: bool = False) -> typing.ContextManager[None]:
+   return resource_lock('tool', folder, f'the tool folder \'{folder}\'', shared)
+
+def save_settings_locked(settings: Settings, settings_path: pathlib.Path):
+   with settings_lock(settings_path):
+      save_settings(settings, settings_path)
+
+def run_process(args: list[str], **kwargs: typing.Any) -> subprocess.CompletedProcess:
+   name = ' '.join(pathlib.PureWindowsPath(arg).name for arg in args[:3])
+   with PROFILER.span(name, 'subprocess') as span:
+      span.args['args'] = args
+      return subprocess.run(args, **kwargs)
+
 class Environment:
    @abc.abstractmethod
    def user_folder(self, game: KhGame) -> pathlib.Path: pass
@@ -338,7 +1075,7 @@ class Environment:
    @abc.abstractmethod
    def run_program(self, game: KhGame, args: list[str]) -> subprocess.CompletedProcess: pass
    @abc.abstractmethod
-   def make_launch(self, file: typing.TextIO, directory: pathlib.PureWindowsPath, exe: pathlib.PureWindowsPath, env: dict[str, str]): pass
+   def make_launch(self, file: typing.TextIO, game: KhGame, launch: LaunchExe, env: dict[str, str], before: list[str]): pass
    @classmethod
    @abc.abstractmethod
    def is_linux(cls) -> bool: pass
@@ -354,14 +1091,17 @@ class WindowsEnvironment(Environment):
       return pathlib.Path(path)
 
    def run_program(self, game: KhGame, args: list[str]) -> subprocess.CompletedProcess:
-      return subprocess.run(args, check=True)
+      return run_process(args, check=True)
 
-   def make_launch(self, file: typing.TextIO, directory: pathlib.PureWindowsPath, exe: pathlib.PureWindowsPath, env: dict[str, str]):
+   def make_launch(self, file: typing.TextIO, game: KhGame, launch: LaunchExe, env: dict[str, str], before: list[str]):
+      directory = self.convert_path(game, game.get_workspace())
+      exe = self.convert_path(game, game.folder / launch.exe())
       file.writelines([
-         '@echo off',
+         '@echo off\n',
+         *([f'{mslex.join(before)}\n'] if len(before) > 0 else []),
          f'cd /d {mslex.quote(str(directory))} || exit 1\n',
-         *[f'set {key}={mslex.quote(value)}' for key, value in env.items()],
-         f'{mslex.quote(str(exe))}\n',
+         *[f'set {key}={mslex.quote(value)}\n' for key, value in env.items()],
+         f'{mslex.join([*launch.wrapper, str(exe)])}\n',
       ])
 
    @classmethod
@@ -369,119 +1109,277 @@ class WindowsEnvironment(Environment):
       return False
 
 class LinuxEnvironment(Environment):
-   def __init__(self, runtime: WineRuntime):
+   def __init__(self, runtime: WineRuntime, proton: pathlib.Path | None):
       self.runtime = runtime
+      self.proton_path = 'GE-Proton' if proton is None else str(proton)
+      self.path_cache: dict[tuple[str, str, str], str] = {}
 
    def user_folder(self, game: KhGame) -> pathlib.Path:
       assert game.wineprefix is not None
-      return game.wineprefix / 'drive_c/users' / os.getlogin()
+      return game.wineprefix / 'drive_c/users' / getpass.getuser()
 
    def wine_env(self, game: KhGame) -> dict[str, str]:
       assert game.wineprefix is not None
       env: dict[str, str] = dict(os.environ)
       env['WINEPREFIX'] = str(game.wineprefix)
       if self.runtime == 'umu':
-         env['PROTONPATH'] = 'GE-Proton'
+         env['PROTONPATH'] = self.proton_path
       return env
 
+   def winepath(self, game: KhGame, direction: str, path: str) -> str:
+      key = (str(game.wineprefix), direction, path)
+      if key not in self.path_cache:
+         self.path_cache[key] = run_process(
+            ['winepath', direction, path],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=self.wine_env(game)
+         ).stdout.decode('utf-8').rstrip('\n')
+      return self.path_cache[key]
+
    def convert_path(self, game: KhGame, path: pathlib.Path) -> pathlib.PureWindowsPath:
-      result = subprocess.run(
-         ['winepath', '--windows', str(path)],
-         check=True,
-         stdout=subprocess.PIPE,
-         stderr=subprocess.DEVNULL,
-         env=self.wine_env(game)
-      ).stdout.decode('utf-8').rstrip('\n')
-      return pathlib.PureWindowsPath(result)
+      return pathlib.PureWindowsPath(self.winepath(game, '--windows', str(path)))
 
    def convert_path_back(self, game: KhGame, path: pathlib.PureWindowsPath) -> pathlib.Path:
-      result = subprocess.run(
-         ['winepath', '--unix', str(path)],
-         check=True,
-         stdout=subprocess.PIPE,
-         stderr=subprocess.DEVNULL,
-         env=self.wine_env(game)
-      ).stdout.decode('utf-8').rstrip('\n')
-      return pathlib.Path(result)
+      return pathlib.Path(self.winepath(game, '--unix', str(path)))
 
    def run_program(self, game: KhGame, args: list[str]) -> subprocess.CompletedProcess:
       cmds = ['wine']
       cmds.extend(args)
-      return subprocess.run(
+      return run_process(
          cmds,
          check=True,
          env=self.wine_env(game)
       )
 
-   def make_launch(self, file: typing.TextIO, directory: pathlib.PureWindowsPath, exe: pathlib.PureWindowsPath, env: dict[str, str]):
+   def make_launch(self, file: typing.TextIO, game: KhGame, launch: LaunchExe, env: dict[str, str], before: list[str]):
       env_str = ' '.join(f'{key}={shlex.quote(value)}' for key, value in env.items())
-      entry = {'wine': 'wine', 'umu': 'umu-run'}[self.runtime]
-      file.writelines([
-         '#!/bin/sh\n',
-         f'{env_str} exec {entry} start /wait /b /d {shlex.quote(str(directory))} {shlex.quote(str(exe))}\n',
-      ])
+      runtime = launch.runtime if launch.runtime is not None else self.runtime
+      entry = shlex.join([*launch.wrapper, {'wine': 'wine', 'umu': 'umu-run'}[runtime]])
+      prelude = [f'{shlex.join(before)}\n'] if len(before) > 0 else []
+      match launch.mode:
+         case 'start':
+            directory = self.convert_path(game, game.get_workspace())
+            exe = self.convert_path(game, game.folder / launch.exe())
+            file.writelines([
+               '#!/bin/sh\n',
+               *prelude,
+               f'{env_str} exec {entry} start /wait /b /d {shlex.quote(str(directory))} {shlex.quote(str(exe))}\n',
+            ])
+         case 'direct':
+            file.writelines([
+               '#!/bin/sh\n',
+               *prelude,
+               f'cd {shlex.quote(str(game.get_workspace()))} || exit 1\n',
+               f'{env_str} exec {entry} {shlex.quote(str(game.folder / launch.exe()))}\n',
+            ])
+
+   def prewarm(self, game: KhGame):
+      assert game.wineprefix is not None
+      print(f'Starting wineserver for \'{game.wineprefix}\'')
+      run_process(
+         ['wineserver', '--persistent'],
+         env=self.wine_env(game),
+         stdin=subprocess.DEVNULL,
+         stdout=subprocess.DEVNULL,
+         stderr=subprocess.DEVNULL
+      )
 
    @classmethod
    def is_linux(cls) -> bool:
       return True
 
-def get_enabled_mods(game: str, openkh: OpenKh) -> list[pathlib.PurePath]:
+def enabled_mods_path(game: str, openkh: OpenKh) -> pathlib.Path:
    game_txt = {'kh1': 'KH1', 'kh2': 'KH2', 'khbbs': 'BBS', 'khrecom': 'ReCoM', 'khddd': 'KH3D'}[game]
-   enabled_path = openkh.folder / f'mods-{game_txt}.txt'
-   if enabled_path.exists():
-      with open(enabled_path, 'r', encoding='utf-8') as file:
+   return openkh.folder / f'mods-{game_txt}.txt'
+
+def read_mod_list(path: pathlib.Path) -> list[pathlib.PurePath]:
+   if path.exists():
+      with open(path, 'r', encoding='utf-8') as file:
          return [pathlib.PurePath(line.rstrip('\n')) for line in file.readlines()]
    return []
 
+def get_enabled_mods(game: str, openkh: OpenKh) -> list[pathlib.PurePath]:
+   return read_mod_list(enabled_mods_path(game, openkh))
+
 def set_enabled_mods(game: str, mods: list[pathlib.PurePath], openkh: OpenKh):
-   game_txt = {'kh1': 'KH1', 'kh2': 'KH2', 'khbbs': 'BBS', 'khrecom': 'ReCoM', 'khddd': 'KH3D'}[game]
-   enabled_path = openkh.folder / f'mods-{game_txt}.txt'
-   with open(enabled_path, 'w', encoding='utf-8') as file:
+   enabled_path = enabled_mods_path(game, openkh).resolve()
+   temp_path = enabled_path.with_name(enabled_path.name + '.tmp')
+   with open(temp_path, 'w', encoding='utf-8') as file:
       file.writelines(str(line) + '\n' for line in mods)
+   temp_path.replace(enabled_path)
+
+class ModIndex:
+   def __init__(self, mods: pathlib.Path, settings: Settings):
+      self.mods = mods
+      self.path = cache_folder(settings) / 'mod-index' / (hashlib.sha256(str(mods.resolve()).encode('utf-8')).hexdigest()[:16] + '.json')
+      self.folders: dict[str, dict[str, typing.Any]] = {}
+      if self.path.exists():
+         try:
+            with open(self.path, 'r', encoding='utf-8') as index_file:
+               self.folders = json.load(index_file)
+         except (json.JSONDecodeError, OSError):
+            self.folders = {}
+
+   def scan(self) -> list[pathlib.PurePath]:
+      found: list[pathlib.PurePath] = []
+      folders: dict[str, dict[str, typing.Any]] = {}
+      pending: list[str] = ['.']
+      while len(pending) > 0:
+         relative = pending.pop()
+         folder = self.mods / relative
+         try:
+            mtime = folder.stat().st_mtime_ns
+         except FileNotFoundError:
+            continue
+         entry = self.folders.get(relative)
+         if entry is None or entry['mtime'] != mtime:
+            is_mod = False
+            children: list[str] = []
+            with os.scandir(folder) as scan:
+               for child in scan:
+                  if child.name == 'mod.yml' and child.is_file():
+                     is_mod = True
+                  elif child.name != '.git' and child.is_dir(follow_symlinks=False):
+                     children.append(child.name)
+            entry = {'mtime': mtime, 'mod': is_mod, 'children': [] if is_mod else sorted(children)}
+         folders[relative] = entry
+         if entry['mod']:
+            found.append(pathlib.PurePath(relative))
+         else:
+            pending.extend(str(pathlib.PurePath(relative) / child) for child in reversed(entry['children']))
+      if folders != self.folders:
+         self.folders = folders
+         self.save()
+      return found
+
+   def save(self):
+      temp_path = self.path.with_name(self.path.name + '.tmp')
+      try:
+         self.path.parent.mkdir(parents=True, exist_ok=True)
+         with open(temp_path, 'w', encoding='utf-8') as index_file:
+            json.dump(self.folders, index_file)
+         temp_path.replace(self.path)
+         (self.mods / '.mod-index.json').unlink(missing_ok=True)
+      except OSError:
+         temp_path.unlink(missing_ok=True)
 
 def list_mods(game: str, environment: Environment, settings: Settings, openkh: OpenKh, openkh_settings: dict[str, typing.Any]):
    mods = mods_folder(game, environment, settings, openkh_settings)
    if mods is None:
       print(f'Game {game} not found')
       return
-   all_mods: list[pathlib.PurePath] = []
-   for root, _folders, _files in mods.walk():
-      if (root / 'mod.yml').exists():
-         all_mods.append(root.relative_to(mods))
+   all_mods = ModIndex(mods, settings).scan() if mods.exists() else []
+   installed = set(all_mods)
    enabled_mods = get_enabled_mods(game, openkh)
+   enabled = set(enabled_mods)
    print('Enabled:')
    for mod in enabled_mods:
-      if mod in all_mods:
+      if mod in installed:
          print(f'- {mod}')
       else:
          print(f'- {mod} (missing)')
    print('Available:')
    for mod in all_mods:
-      if mod not in enabled_mods:
+      if mod not in enabled:
          print(f'- {mod}')
 
-def download_mod(game: str, mod: pathlib.PurePath, environment: Environment, settings: Settings, openkh: OpenKh, openkh_settings: dict[str, typing.Any]):
-   url = f'https://github.com/{mod}'
+def mod_profile_path(game: str, name: str, openkh: OpenKh) -> pathlib.Path | None:
+   if pathlib.PurePath(name).name != name or name.startswith('.'):
+      print(f'Invalid profile name {name}')
+      return None
+   mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
+   return mods / 'profiles' / game / f'{name}.txt'
+
+def list_mod_profiles(game: str, openkh: OpenKh):
+   mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
+   folder = mods / 'profiles' / game
+   profiles = sorted(folder.glob('*.txt')) if folder.exists() else []
+   if len(profiles) == 0:
+      print(f'No mod profiles for {game}')
+      return
+   enabled = get_enabled_mods(game, openkh)
+   for profile in profiles:
+      profile_mods = read_mod_list(profile)
+      print(f'- {profile.stem}: {len(profile_mods)} mods{" (active)" if profile_mods == enabled else ""}')
+
+def save_mod_profile(game: str, name: str, openkh: OpenKh):
+   if (path := mod_profile_path(game, name, openkh)) is None:
+      return
+   enabled = get_enabled_mods(game, openkh)
+   path.parent.mkdir(parents=True, exist_ok=True)
+   with open(path, 'w', encoding='utf-8') as file:
+      file.writelines(str(line) + '\n' for line in enabled)
+   print(f'Saved {len(enabled)} enabled mods in {game} as profile {name}')
+
+def load_mod_profile(game: str, name: str, environment: Environment, settings: Settings, openkh: OpenKh, openkh_settings: dict[str, typing.Any]):
+   if (path := mod_profile_path(game, name, openkh)) is None:
+      return
+   if not path.exists():
+      print(f'Mod profile {name} in {game} not found')
+      return
+   profile_mods = read_mod_list(path)
+   mods = mods_folder(game, environment, settings, openkh_settings)
+   installed = set(ModIndex(mods, settings).scan()) if mods is not None and mods.exists() else set()
+   for mod in profile_mods:
+      if mod not in installed:
+         print(f'Mod {mod} in profile {name} is not installed')
+   with build_lock(enabled_mods_path(game, openkh)):
+      set_enabled_mods(game, profile_mods, openkh)
+   print(f'Loaded mod profile {name} in {game}, run update to apply it')
+
+def delete_mod_profile(game: str, name: str, openkh: OpenKh):
+   if (path := mod_profile_path(game, name, openkh)) is None:
+      return
+   if not path.exists():
+      print(f'Mod profile {name} in {game} not found')
+      return
+   path.unlink()
+   print(f'Deleted mod profile {name} in {game}')
+
+def download_mods(game: str, requested: list[pathlib.PurePath], jobs: int, environment: Environment, settings: Settings, openkh: OpenKh, openkh_settings: dict[str, typing.Any]):
    mods = mods_folder(game, environment, settings, openkh_settings)
    if mods is None:
       print(f'Game {game} not found')
       return
-   folder = mods / mod
+   requested = list(dict.fromkeys(requested))
+   quiet = jobs > 1 and len(requested) > 1
+   failed: dict[pathlib.PurePath, BaseException] = {}
+   def fetch(mod: pathlib.PurePath):
+      try:
+         download_mod(mod, mods / mod, quiet, settings)
+         EVENTS.emit('git', action='add', mod=str(mod), ok=True)
+      except (subprocess.CalledProcessError, OSError) as error:
+         print(f'Can\'t get mod {mod}: {error}')
+         EVENTS.emit('git', action='add', mod=str(mod), ok=False, error=str(error))
+         failed[mod] = error
+   with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+      list(executor.map(fetch, requested))
+   added = [mod for mod in requested if mod not in failed]
+   with build_lock(enabled_mods_path(game, openkh)):
+      enabled = get_enabled_mods(game, openkh)
+      set_enabled_mods(game, [*added, *(mod for mod in enabled if mod not in added)], openkh)
+   print(f'Added {len(added)} of {len(requested)} mods')
+
+def download_mod(mod: pathlib.PurePath, folder: pathlib.Path, quiet: bool, settings: Settings):
+   url = f'{GITHUB}/{mod}'
    folder.mkdir(parents=True, exist_ok=True)
+   quiet_args = ['--quiet'] if quiet else []
    if (folder / '.git').exists():
-      subprocess.run(
-         ['git', 'pull', '--recurse-submodules'],
+      print(f'Updating mod {mod}')
+      run_process(
+         ['git', 'pull', '--recurse-submodules', *quiet_args],
          cwd=folder,
          check=True
       )
    else:
-      subprocess.run(
-         ['git', 'clone', '--recurse-submodules', url, str(folder)],
+      print(f'Cloning mod {mod}')
+      mirror = git_mirror(url, settings)
+      run_process(
+         ['git', 'clone', '--recurse-submodules', *quiet_args, *([] if mirror is None else ['--reference-if-able', str(mirror), '--dissociate']), url, str(folder)],
          check=True
       )
-   mods = get_enabled_mods(game, openkh)
-   mods.insert(0, mod)
-   set_enabled_mods(game, mods, openkh)
 
 def mods_folder(game: str, environment: Environment, settings: Settings, openkh_settings: dict[str, typing.Any]) -> pathlib.Path | None:
    mod_in = pathlib.PureWindowsPath(openkh_settings['modCollectionPath'])
@@ -509,17 +1407,17 @@ def disable_mod(game: str, mod: pathlib.PurePath, environment: Environment, sett
    if mods is None:
       print(f'Game {game} not found')
       return
-   folder = mods / mod
-   if not folder.exists():
-      print(f'Mod {mod} in {game} not found')
-      return
-   enabled_mods = get_enabled_mods(game, openkh)
-   if mod not in enabled_mods:
-      print(f'Mod {mod} in {game} is already disabled')
-      return
-   print(f'Disabled mod {mod} in {game}')
-   enabled_mods.remove(mod)
-   set_enabled_mods(game, enabled_mods, openkh)
+   with build_lock(enabled_mods_path(game, openkh)):
+      enabled_mods = get_enabled_mods(game, openkh)
+      if not (mods / mod).exists() and mod not in enabled_mods:
+         print(f'Mod {mod} in {game} not found')
+         return
+      if mod not in enabled_mods:
+         print(f'Mod {mod} in {game} is already disabled')
+         return
+      print(f'Disabled mod {mod} in {game}')
+      enabled_mods.remove(mod)
+      set_enabled_mods(game, enabled_mods, openkh)
 
 ModOrder = typing.Literal['top', 'bottom'] | tuple[typing.Literal['above', 'below'], pathlib.PurePath]
 
@@ -528,36 +1426,35 @@ def enable_mod(game: str, mod: pathlib.PurePath, order: ModOrder, environment: E
    if mods is None:
       print(f'Game {game} not found')
       return
-   folder = mods / mod
-   if not folder.exists():
+   if not (mods / mod).exists():
       print(f'Mod {mod} in {game} not found')
       return
-   enabled_mods = get_enabled_mods(game, openkh)
-   if mod in enabled_mods:
-      enabled_mods.remove(mod)
-   match order:
-      case 'top':
-         index = 0
-      case 'bottom':
-         index = len(enabled_mods)
-      case (rel, existing):
-         existing_folder = mods / existing
-         if not existing_folder.exists():
-            print(f'Mod {existing} in {game} not found')
-            return
-         if existing not in enabled_mods:
-            print(f'Mod {existing} in {game} not enabled')
-            return
-         match rel:
-            case 'above':
-               index = enabled_mods.index(existing)
-            case 'below':
-               index = enabled_mods.index(existing) + 1
-   print(f'Enabled mod {mod} in {game}')
-   enabled_mods.insert(index, mod)
-   set_enabled_mods(game, enabled_mods, openkh)
-
-def make_env(game: KhGame, environment: Environment, settings: Settings, lua: bool, openkh: bool, refined: bool, kh3: bool) -> dict[str, str]:
+   with build_lock(enabled_mods_path(game, openkh)):
+      enabled_mods = get_enabled_mods(game, openkh)
+      if mod in enabled_mods:
+         enabled_mods.remove(mod)
+      match order:
+         case 'top':
+            index = 0
+         case 'bottom':
+            index = len(enabled_mods)
+         case (rel, existing):
+            if not (mods / existing).exists():
+               print(f'Mod {existing} in {game} not found')
+               return
+            if existing not in enabled_mods:
+               print(f'Mod {existing} in {game} not enabled')
+               return
+            match rel:
+               case 'above':
+                  index = enabled_mods.index(existing)
+               case 'below':
+                  index = enabled_mods.index(existing) + 1
+      print(f'Enabled mod {mod} in {game}')
+      enabled_mods.insert(index, mod)
+      set_enabled_mods(game, enabled_mods, openkh)
+
+def make_env(game: KhGame, launch: LaunchExe, environment: Environment, settings: Settings, lua: bool, openkh: bool, refined: bool, kh3: bool) -> dict[str, str]:
    if not environment.is_linux():
       return {}
    dlls: dict[str, str] = {}
@@ -573,10 +1470,22 @@ def make_env(game: KhGame, environment: Environment, settings: Settings, lua: bo
       'WINE_FULLSCREEN_FSR': '1',
       'WINEDEBUG': '-all'
    }
-   if isinstance(environment, LinuxEnvironment) and environment.runtime == 'umu':
+   cache = shader_cache_folder(launch, settings)
+   if cache is not None:
+      env |= {
+         'DXVK_STATE_CACHE_PATH': str(cache / 'dxvk'),
+         'VKD3D_SHADER_CACHE_PATH': str(cache / 'vkd3d'),
+         'MESA_SHADER_CACHE_DIR': str(cache / 'mesa'),
+         '__GL_SHADER_DISK_CACHE': '1',
+         '__GL_SHADER_DISK_CACHE_PATH': str(cache / 'nvidia'),
+         '__GL_SHADER_DISK_CACHE_SKIP_CLEANUP': '1',
+      }
+   if isinstance(environment, LinuxEnvironment) and (launch.runtime if launch.runtime is not None else environment.runtime) == 'umu':
       read, write = get_access_folders(game, settings, lua=lua, openkh=openkh, refined=refined, kh3=kh3)
+      if cache is not None:
+         write.append(cache)
       env |= {
-         'PROTONPATH': 'GE-Proton',
+         'PROTONPATH': environment.proton_path,
          'GAMEID': game.umu_id(),
          'STORE': {'steam': 'steam', 'epic': 'egs'}[settings.store],
          'PRESSURE_VESSEL_FILESYSTEMS_RO': ':'.join((str(x) for x in read)),
@@ -584,85 +1493,189 @@ def make_env(game: KhGame, environment: Environment, settings: Settings, lua: bo
       }
    return env
 
-def make_launch(game: KhGame, launch: LaunchExe, environment: Environment, settings: Settings, lua: bool, openkh: bool, refined: bool, kh3: bool):
+SHADER_CACHE_KINDS: list[str] = ['dxvk', 'vkd3d', 'mesa', 'nvidia']
+
+def launch_name(launch: LaunchExe) -> str:
+   return type(launch).__name__.removeprefix('Launch').lower()
+
+def shader_cache_folder(launch: LaunchExe, settings: Settings) -> pathlib.Path | None:
+   if settings.shader_cache is None:
+      return None
+   return settings.shader_cache / launch_name(launch)
+
+def folder_size(folder: pathlib.Path) -> tuple[int, int]:
+   size = 0
+   count = 0
+   seen: set[tuple[int, int]] = set()
+   for root, _folders, files in folder.walk():
+      for file in files:
+         try:
+            stats = (root / file).lstat()
+         except FileNotFoundError:
+            continue
+         if stats.st_nlink > 1:
+            if (stats.st_dev, stats.st_ino) in seen:
+               continue
+            seen.add((stats.st_dev, stats.st_ino))
+         size += stats.st_size
+         count += 1
+   return (size, count)
+
+def format_size(size: float) -> str:
+   for unit in ['B', 'KiB', 'MiB', 'GiB']:
+      if size < 1024:
+         return f'{size:.1f} {unit}'
+      size /= 1024
+   return f'{size:.1f} TiB'
+
+def list_shader_caches(settings: Settings):
+   if settings.shader_cache is None:
+      print('No shader_cache folder configured in settings')
+      return
+   total = 0
+   for game in settings.games.get_all():
+      for launch in game.get_exes():
+         cache = shader_cache_folder(launch, settings)
+         assert cache is not None
+         if not cache.exists():
+            continue
+         sizes = {kind: folder_size(cache / kind)[0] for kind in SHADER_CACHE_KINDS if (cache / kind).exists()}
+         total += sum(sizes.values())
+         details = ', '.join(f'{kind} {format_size(size)}' for kind, size in sizes.items())
+         print(f'{launch_name(launch)}: {format_size(sum(sizes.values()))} ({details})')
+   print(f'Total: {format_size(total)}')
+
+def prune_shader_caches(settings: Settings, max_size: int | None, older_than: float | None):
+   if settings.shader_cache is None:
+      print('No shader_cache folder configured in settings')
+      return
+   cutoff = time.time() - older_than * 24 * 60 * 60 if older_than is not None else None
+   for game in settings.games.get_all():
+      for launch in game.get_exes():
+         cache = shader_cache_folder(launch, settings)
+         assert cache is not None
+         if not cache.exists():
+            continue
+         files: list[tuple[float, int, pathlib.Path]] = []
+         for root, _folders, names in cache.walk():
+            for name in names:
+               stats = (root / name).stat()
+               files.append((max(stats.st_atime, stats.st_mtime), stats.st_size, root / name))
+         files.sort()
+         size = sum(file_size for _used, file_size, _path in files)
+         removed = 0
+         for used, file_size, path in files:
+            too_old = cutoff is not None and used < cutoff
+            too_big = max_size is not None and size > max_size
+            if not too_old and not too_big:
+               continue
+            path.unlink()
+            size -= file_size
+            removed += file_size
+         if removed > 0:
+            print(f'Pruned {format_size(removed)} from {launch_name(launch)} shader cache, {format_size(size)} left')
+
+def make_launch(game: KhGame, launch: LaunchExe, environment: Environment, settings: Settings, settings_path: pathlib.Path, lua: bool, openkh: bool, refined: bool, kh3: bool):
    if launch.launch is None:
       return
-   env = make_env(game, environment, settings, lua=lua, openkh=openkh, refined=refined, kh3=kh3)
+   if (cache := shader_cache_folder(launch, settings)) is not None:
+      for kind in SHADER_CACHE_KINDS:
+         (cache / kind).mkdir(parents=True, exist_ok=True)
+   env = make_env(game, launch, environment, settings, lua=lua, openkh=openkh, refined=refined, kh3=kh3) | launch.env
+   before: list[str] = []
+   if settings.snapshots is not None and settings.snapshots.on_launch and game.saves is not None:
+      before = [sys.executable, str(pathlib.Path(__file__).resolve()), '--settings', str(settings_path.resolve()), 'saves', 'snapshot', game_key(game, settings)]
    launch.launch.parent.mkdir(parents=True, exist_ok=True)
    with open(launch.launch, 'w', encoding='utf-8') as sh_file:
-      environment.make_launch(sh_file, environment.convert_path(game, game.get_workspace()), environment.convert_path(game, game.folder / launch.exe()), env)
+      environment.make_launch(sh_file, game, launch, env, before)
    filestat = launch.launch.stat()
    launch.launch.chmod(filestat.st_mode | stat.S_IEXEC)
 
+def prewarm_prefixes(environment: Environment, settings: Settings):
+   if not isinstance(environment, LinuxEnvironment):
+      return
+   prefixes: dict[pathlib.Path, KhGame] = {}
+   for game in settings.games.get_all():
+      for launch in game.get_exes():
+         if not launch.prewarm:
+            continue
+         if (launch.runtime if launch.runtime is not None else environment.runtime) != 'wine':
+            print(f'Can\'t prewarm \'{launch.exe().name}\', only the wine runtime keeps a wineserver outside the game')
+            continue
+         assert game.wineprefix is not None
+         prefixes.setdefault(game.wineprefix, game)
+   for prefix, game in prefixes.items():
+      with prefix_lock(prefix):
+         environment.prewarm(game)
+
 def get_environment(settings: Settings) -> Environment:
-   is_linux = platform.system() == 'Linux'
-   if is_linux:
+   if platform.system() == 'Linux':
       print('Linux detected')
       assert settings.runtime is not None
-      environment = LinuxEnvironment(settings.runtime)
-      for game in settings.games.get_all():
-         assert game.wineprefix is not None
-         game.wineprefix.mkdir(parents=True, exist_ok=True)
-         user_folder = environment.user_folder(game)
-         if not user_folder.exists():
-            print('Creating wineprefix')
-            entry = {'wine': 'wine', 'umu': 'umu-run'}[environment.runtime]
-            subprocess.run(
-               [entry, 'wineboot'],
-               check=True,
-               env=environment.wine_env(game)
-            )
-            subprocess.run(
-               [entry, 'reg', 'add', 'HKEY_LOCAL_MACHINE\\System\\CurrentControlSet\\Services\\winebus', '/f', '/v', 'DisableHidraw', '/t', 'REG_DWORD', '/d', '1'],
-               check=True,
-               env=environment.wine_env(game)
-            )
-            docs_folder = user_folder / 'Documents'
-            if docs_folder.is_symlink():
-               print('Unlinking new documents folder')
-               docs_folder.unlink()
-      for game in settings.games.get_classic():
-         assert game.wineprefix is not None
-         winetricks = get_winetricks(game.wineprefix)
-         if settings.mods.openkh is not None:
-            if 'dotnet8' not in winetricks:
-               print('Installing dotnet8 to wineprefix')
-               subprocess.run(
-                  ['winetricks', '--unattended', 'dotnet8'],
-                  check=True,
-                  env=environment.wine_env(game)
-               )
-         if environment.runtime == 'wine':
-            if 'vkd3d' not in winetricks:
-               print('Installing vkd3d to wineprefix')
-               subprocess.run(
-                  ['winetricks', '--unattended', 'vkd3d'],
-                  check=True,
-                  env=environment.wine_env(game)
-               )
-            if 'dxvk' not in winetricks:
-               print('Installing dxvk to wineprefix')
-               subprocess.run(
-                  ['winetricks', '--unattended', 'dxvk'],
-                  check=True,
-                  env=environment.wine_env(game)
-               )
-         if (game := settings.games.kh3) is not None:
-            assert game.wineprefix is not None
-            winetricks = get_winetricks(game.wineprefix)
-            if environment.runtime == 'wine':
-               if 'wmp11' not in winetricks:
-                  print('Installing wmp11 to wineprefix')
-                  subprocess.run(
-                     ['winetricks', '--unattended', 'wmp11'],
-                     check=True,
-                     env=environment.wine_env(game)
-                  )
-      return environment
+      proton = proton_folder(settings.proton, settings) if settings.proton is not None else None
+      return LinuxEnvironment(settings.runtime, proton)
    else:
       print('Windows detected')
       return WindowsEnvironment()
 
+def prefixes_ready(environment: Environment, settings: Settings) -> bool:
+   if not isinstance(environment, LinuxEnvironment):
+      return True
+   return all(environment.user_folder(game).exists() for game in settings.games.get_all())
+
+def provision_prefixes(environment: Environment, settings: Settings):
+   if not isinstance(environment, LinuxEnvironment):
+      return
+   for game in settings.games.get_all():
+      assert game.wineprefix is not None
+      with prefix_lock(game.wineprefix):
+         provision_prefix(game, environment)
+   for game in settings.games.get_classic():
+      assert game.wineprefix is not None
+      with prefix_lock(game.wineprefix):
+         winetricks = get_winetricks(game.wineprefix)
+         if settings.mods.openkh is not None:
+            install_winetrick(game, 'dotnet8', winetricks, environment)
+         if environment.runtime == 'wine':
+            install_winetrick(game, 'vkd3d', winetricks, environment)
+            install_winetrick(game, 'dxvk', winetricks, environment)
+   if (game := settings.games.kh3) is not None and environment.runtime == 'wine':
+      assert game.wineprefix is not None
+      with prefix_lock(game.wineprefix):
+         install_winetrick(game, 'wmp11', get_winetricks(game.wineprefix), environment)
+
+def provision_prefix(game: KhGame, environment: LinuxEnvironment):
+   assert game.wineprefix is not None
+   game.wineprefix.mkdir(parents=True, exist_ok=True)
+   user_folder = environment.user_folder(game)
+   if not user_folder.exists():
+      print('Creating wineprefix')
+      entry = {'wine': 'wine', 'umu': 'umu-run'}[environment.runtime]
+      run_process(
+         [entry, 'wineboot'],
+         check=True,
+         env=environment.wine_env(game)
+      )
+      run_process(
+         [entry, 'reg', 'add', 'HKEY_LOCAL_MACHINE\\System\\CurrentControlSet\\Services\\winebus', '/f', '/v', 'DisableHidraw', '/t', 'REG_DWORD', '/d', '1'],
+         check=True,
+         env=environment.wine_env(game)
+      )
+      docs_folder = user_folder / 'Documents'
+      if docs_folder.is_symlink():
+         print('Unlinking new documents folder')
+         docs_folder.unlink()
+
+def install_winetrick(game: KhGame, verb: str, installed: list[str], environment: LinuxEnvironment):
+   if verb in installed:
+      return
+   print(f'Installing {verb} to wineprefix')
+   run_process(
+      ['winetricks', '--unattended', verb],
+      check=True,
+      env=environment.wine_env(game)
+   )
+
 def get_winetricks(prefix: pathlib.Path) -> list[str]:
    winetricks: list[str] = []
    winetricks_log = prefix / 'winetricks.log'
@@ -672,33 +1685,122 @@ def get_winetricks(prefix: pathlib.Path) -> list[str]:
    return winetricks
 
 class Symlinks:
-   def __init__(self):
+   def __init__(self, manifest: pathlib.Path | None = None, dry_run: bool = False):
       self.remove_symlinks: set[pathlib.Path] = set()
+      self.links: dict[pathlib.Path, pathlib.Path] = {}
+      self.directories: dict[pathlib.Path, bool] = {}
+      self.manifest = manifest
+      self.dry_run = dry_run
+      self.known: dict[pathlib.Path, tuple[pathlib.Path, bool]] | None = None
+      self.complete = False
+      if manifest is not None and manifest.exists():
+         self.known, self.complete = load_manifest(manifest)
+      self.counts: dict[str, int] = {'created': 0, 'replaced': 0, 'removed': 0, 'blocked': 0, 'unchanged': 0}
+      self.lock = threading.Lock()
 
    def remove(self, path: pathlib.Path):
-      self.remove_symlinks.add(path)
+      with self.lock:
+         self.remove_symlinks.add(path)
 
    def make(self, new: pathlib.Path, existing: pathlib.Path, is_dir: bool):
-      if new in self.remove_symlinks:
-         self.remove_symlinks.remove(new)
+      with self.lock:
+         self.links[new] = existing
+         self.directories[new] = is_dir
+         if new in self.remove_symlinks:
+            self.remove_symlinks.remove(new)
+         if self.known is not None and self.known.get(new) == (existing, is_dir):
+            try:
+               if pathlib.Path(os.readlink(new)) == existing:
+                  self.counts['unchanged'] += 1
+                  return
+            except OSError:
+               pass
+         self.apply(new, existing, is_dir)
+
+   def apply(self, new: pathlib.Path, existing: pathlib.Path, is_dir: bool):
       if new.is_symlink():
          target = new.readlink()
          if target == existing:
+            self.counts['unchanged'] += 1
             return
          print(f'Removing previous symlink in \'{new}\' pointing to \'{target}\'')
-         new.unlink()
-      if not new.exists():
-         print(f'Creating symlink in \'{new}\' pointing to \'{existing}\'')
-         new.parent.mkdir(parents=True, exist_ok=True)
-         new.symlink_to(existing, target_is_directory=is_dir)
-      else:
+         self.counts['replaced'] += 1
+         EVENTS.emit('symlink', action='replaced', path=str(new), old_target=str(target), target=str(existing), dry_run=self.dry_run)
+         if not self.dry_run:
+            new.unlink()
+      elif new.exists():
          print(f'Can\'t create symlink in \'{new}\' pointing to \'{existing}\', file already exists!')
-
-   def commit(self):
+         self.counts['blocked'] += 1
+         EVENTS.emit('symlink', action='blocked', path=str(new), target=str(existing), dry_run=self.dry_run)
+         return
+      else:
+         self.counts['created'] += 1
+         EVENTS.emit('symlink', action='created', path=str(new), target=str(existing), dry_run=self.dry_run)
+      print(f'Creating symlink in \'{new}\' pointing to \'{existing}\'')
+      if self.dry_run:
+         return
+      new.parent.mkdir(parents=True, exist_ok=True)
+      new.symlink_to(existing, target_is_directory=is_dir)
+      if self.manifest is not None:
+         with settings_lock(self.manifest):
+            known, complete = load_manifest(self.manifest)
+            known[new] = (existing, is_dir)
+            save_links(self.manifest, known, complete)
+
+   def commit(self, complete: bool = False):
       for path in self.remove_symlinks:
+         if self.complete and self.known is not None and path not in self.known:
+            continue
          if path.is_symlink():
             print(f'Removing symlink \'{path}\'')
-            path.unlink()
+            self.counts['removed'] += 1
+            EVENTS.emit('symlink', action='removed', path=str(path), dry_run=self.dry_run)
+            if not self.dry_run:
+               path.unlink()
+      if self.manifest is not None and not self.dry_run:
+         with settings_lock(self.manifest):
+            known, was_complete = load_manifest(self.manifest)
+            for path in self.remove_symlinks:
+               known.pop(path, None)
+            for path, target in self.links.items():
+               known[path] = (target, self.directories[path])
+            save_links(self.manifest, known, complete or was_complete)
+      changes = ', '.join(f'{count} {kind}' for kind, count in self.counts.items() if count > 0 and kind != 'unchanged')
+      print(f'Symlinks{" (dry run)" if self.dry_run else ""}: {changes if changes != "" else "no changes"}, {self.counts["unchanged"]} unchanged')
+
+def links_path(settings_path: pathlib.Path) -> pathlib.Path:
+   return settings_path.with_suffix('.links.json')
+
+def load_links(path: pathlib.Path) -> dict[pathlib.Path, tuple[pathlib.Path, bool]]:
+   return load_manifest(path)[0]
+
+def load_manifest(path: pathlib.Path) -> tuple[dict[pathlib.Path, tuple[pathlib.Path, bool]], bool]:
+   if not path.exists():
+      return ({}, False)
+   try:
+      with open(path, 'r', encoding='utf-8') as links_file:
+         data = json.load(links_file)
+      if 'links' in data:
+         return ({pathlib.Path(link): (pathlib.Path(target), is_dir) for link, (target, is_dir) in data['links'].items()}, data.get('complete', False))
+      return ({pathlib.Path(link): (pathlib.Path(target), is_dir) for link, (target, is_dir) in data.items()}, False)
+   except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+      print(f'Ignoring unreadable symlink manifest \'{path}\'')
+      return ({}, False)
+
+def save_links(path: pathlib.Path, links: dict[pathlib.Path, tuple[pathlib.Path, bool]], complete: bool):
+   temp_path = path.with_name(path.name + '.tmp')
+   with open(temp_path, 'w', encoding='utf-8') as links_file:
+      json.dump({'complete': complete, 'links': {str(link): [str(target), is_dir] for link, (target, is_dir) in sorted(links.items())}}, links_file, indent=1)
+   temp_path.replace(path)
+
+def check_links(settings_path: pathlib.Path, dry_run: bool):
+   symlinks = Symlinks(links_path(settings_path), dry_run)
+   if symlinks.known is None:
+      print('No symlink manifest yet, run update first')
+      return
+   for path, (target, is_dir) in symlinks.known.items():
+      symlinks.make(path, target, is_dir)
+   symlinks.commit()
 
 def handle_saves(game: KhGame, symlinks: Symlinks, environment: Environment, settings: Settings):
    path_part = game.saves_folder()
@@ -716,6 +1818,116 @@ def handle_saves(game: KhGame, symlinks: Symlinks, environment: Environment, set
       if steam_id is not None:
          symlinks.remove(user_folder / 'Documents/My Games' / path_part / 'Steam' / str(steam_id))
 
+def game_key(game: KhGame, settings: Settings) -> str:
+   return next(field.name for field in dataclasses.fields(settings.games) if getattr(settings.games, field.name) is game)
+
+def snapshot_folder(key: str, saves: pathlib.Path, snapshots: Snapshots) -> pathlib.Path:
+   if snapshots.folder is not None:
+      return snapshots.folder / key
+   return saves.with_name(saves.name + '.snapshots')
+
+def saves_with_snapshots(settings: Settings, key: str | None) -> list[tuple[str, pathlib.Path, pathlib.Path]]:
+   snapshots = settings.snapshots if settings.snapshots is not None else Snapshots()
+   result: list[tuple[str, pathlib.Path, pathlib.Path]] = []
+   for game in settings.games.get_all():
+      name = game_key(game, settings)
+      if game.saves is None or (key is not None and name != key):
+         continue
+      result.append((name, game.saves, snapshot_folder(name, game.saves, snapshots)))
+   if key is not None and len(result) == 0:
+      print(f'No saves folder configured for \'{key}\'')
+   return result
+
+def list_snapshots(folder: pathlib.Path) -> list[pathlib.Path]:
+   if not folder.exists():
+      return []
+   return sorted(path for path in folder.iterdir() if path.is_dir() and not path.name.startswith('.'))
+
+def snapshot_saves(saves: pathlib.Path, folder: pathlib.Path, keep: int):
+   if not saves.exists():
+      return
+   existing = list_snapshots(folder)
+   latest = existing[-1] if len(existing) > 0 else None
+   name = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+   temp = folder / f'.{name}'
+   if temp.exists():
+      shutil.rmtree(temp)
+   changed = False
+   seen: set[pathlib.PurePath] = set()
+   for root, _dirs, files in os.walk(saves):
+      relative = pathlib.Path(root).relative_to(saves)
+      (temp / relative).mkdir(parents=True, exist_ok=True)
+      for file in files:
+         source = pathlib.Path(root) / file
+         seen.add(relative / file)
+         source_stat = source.stat()
+         if latest is not None and (previous := latest / relative / file).exists():
+            previous_stat = previous.stat()
+            if previous_stat.st_size == source_stat.st_size and previous_stat.st_mtime_ns == source_stat.st_mtime_ns:
+               os.link(previous, temp / relative / file)
+               continue
+         shutil.copy2(source, temp / relative / file)
+         changed = True
+   if latest is not None and not changed:
+      changed = any(pathlib.Path(root).relative_to(latest) / file not in seen for root, _dirs, files in os.walk(latest) for file in files)
+   if latest is not None and not changed:
+      shutil.rmtree(temp)
+      print(f'Saves in \'{saves}\' unchanged since snapshot {latest.name}')
+   else:
+      destination = folder / name
+      if destination.exists():
+         shutil.rmtree(destination)
+      temp.rename(destination)
+      print(f'Saved snapshot {name} of \'{saves}\'')
+      existing.append(destination)
+   for old in existing[:max(len(existing) - max(keep, 1), 0)]:
+      shutil.rmtree(old)
+
+def snapshot_all_saves(settings: Settings, key: str | None):
+   snapshots = settings.snapshots if settings.snapshots is not None else Snapshots()
+   for _name, saves, folder in saves_with_snapshots(settings, key):
+      snapshot_saves(saves, folder, snapshots.keep)
+
+def list_save_snapshots(settings: Settings, key: str | None):
+   for name, _saves, folder in saves_with_snapshots(settings, key):
+      print(f'{name}:')
+      seen: set[tuple[int, int]] = set()
+      for snapshot in list_snapshots(folder):
+         new_size = 0
+         count = 0
+         for root, _dirs, files in os.walk(snapshot):
+            for file in files:
+               stats = (pathlib.Path(root) / file).stat()
+               count += 1
+               if (stats.st_dev, stats.st_ino) not in seen:
+                  seen.add((stats.st_dev, stats.st_ino))
+                  new_size += stats.st_size
+         print(f'   {snapshot.name}  {count} files, {format_size(new_size)} new')
+
+def restore_save_snapshot(settings: Settings, key: str, name: str | None):
+   for _name, saves, folder in saves_with_snapshots(settings, key):
+      existing = list_snapshots(folder)
+      if len(existing) == 0:
+         print(f'No snapshots in \'{folder}\'')
+         return
+      snapshot = existing[-1] if name is None else next((path for path in existing if path.name == name), None)
+      if snapshot is None:
+         print(f'No snapshot named \'{name}\' in \'{folder}\'')
+         return
+      snapshot_saves(saves, folder, len(existing) + 1)
+      staging = saves.with_name(f'.{saves.name}.restore')
+      if staging.exists():
+         shutil.rmtree(staging)
+      shutil.copytree(snapshot, staging)
+      previous = saves.with_name(f'.{saves.name}.previous')
+      if previous.exists():
+         shutil.rmtree(previous)
+      if saves.exists():
+         saves.rename(previous)
+      staging.rename(saves)
+      shutil.rmtree(previous, ignore_errors=True)
+      print(f'Restored \'{saves}\' from snapshot {snapshot.name}')
+
 def check_saves(symlinks: Symlinks, environment: Environment, settings: Settings):
    print('Checking save folders')
    for game in settings.games.get_all():
@@ -729,25 +1941,41 @@ def check_saves(symlinks: Symlinks, environment: Environment, settings: Settings
          symlinks.remove(user_folder / 'Documents/Kingdom Hearts/Configuration')
          symlinks.remove(user_folder / 'Documents/Kingdom Hearts/Save Data')
 
-def check_openkh(openkh: OpenKh, symlinks: Symlinks, environment: Environment, settings: Settings, settings_path: pathlib.Path, check_updates: bool) -> dict[str, typing.Any]:
+def fetch_openkh(openkh: OpenKh, settings: Settings, settings_path: pathlib.Path, check_updates: bool, offline: bool):
    print('Checking OpenKh')
+   if not openkh.folder.exists() and offline:
+      raise ValueError(f'OpenKh is not installed in \'{openkh.folder}\' and can\'t be downloaded offline')
+   due = check_updates and not offline and update_due(openkh.update, openkh.check_interval, openkh.last_check)
+   if not due and install_settled(openkh.folder):
+      return
+   with tool_lock(openkh.folder):
+      intact = verify_install(openkh.folder, offline)
+      if due or not intact:
+         print('Checking for OpenKh updates...')
+         downloaded = download_latest(
+            last_date = openkh.update if isinstance(openkh.update, datetime.datetime) and intact else None,
+            url = f'{GITHUB_API}/repos/OpenKH/OpenKh/releases/tags/latest',
+            asset_filter = lambda x: x['name'] == 'openkh.zip',
+            has_extra_folder = True,
+            extract_filter = None,
+            destination_folder = openkh.folder,
+            cache = cache_folder(settings) / 'downloads'
+         )
+         changed = False
+         if downloaded is not None and openkh.update != False:
+            openkh.update = downloaded
+            changed = True
+         if openkh.check_interval is not None:
+            openkh.last_check = now()
+            changed = True
+         if changed:
+            save_settings_locked(settings, settings_path)
+
+def check_openkh(openkh: OpenKh, symlinks: Symlinks, environment: Environment, settings: Settings, settings_path: pathlib.Path, check_updates: bool, offline: bool, fetch: bool = True) -> dict[str, typing.Any]:
+   if fetch:
+      fetch_openkh(openkh, settings, settings_path, check_updates, offline)
    default_manager_settings = openkh.folder / 'mods-manager.yml'
    manager_settings = openkh.settings if openkh.settings is not None else default_manager_settings
-   if (openkh.update != False and check_updates) or not openkh.folder.exists():
-      print('Checking for OpenKh updates...')
-      downloaded = download_latest(
-         last_date = openkh.update if isinstance(openkh.update, datetime.datetime) else None,
-         url = 'https://api.github.com/repos/OpenKH/OpenKh/releases/tags/latest',
-         asset_filter = lambda x: x['name'] == 'openkh.zip',
-         has_extra_folder = True,
-         extract_filter = None,
-         destination_folder = openkh.folder
-      )
-      if downloaded is not None:
-         if openkh.update != False:
-            openkh.update = downloaded
-            save_settings(settings, settings_path)
-
    print('Checking mod manager configuration')
    use_game = settings.games.kh15_25
    if use_game is None:
@@ -831,6 +2059,7 @@ def check_openkh(openkh: OpenKh, symlinks: Symlinks, environment: Environment, s
          symlinks.make(folder / 'dependencies/swresample-vgmstream-4.dll', openkh.folder / 'swresample-vgmstream-4.dll', is_dir=False)
       if not openkh.panacea.settings.exists():
          print('Creating default panacea settings')
+         openkh.panacea.settings.parent.mkdir(parents=True, exist_ok=True)
          with open(openkh.panacea.settings, 'w', encoding='utf-8') as mods_file:
             mods_file.writelines([
                'show_console=False\n',
@@ -846,129 +2075,723 @@ def check_openkh(openkh: OpenKh, symlinks: Symlinks, environment: Environment, s
 
    return mgr_data
 
-def mod_games(openkh: OpenKh, openkh_settings: dict[str, typing.Any], environment: Environment, settings: Settings, settings_path: pathlib.Path):
+def mod_games(openkh: OpenKh, openkh_settings: dict[str, typing.Any], environment: Environment, settings: Settings, settings_path: pathlib.Path, offline: bool):
    rebuild: set[str] = set()
-   if openkh.update_mods:
+   if not offline and update_due(openkh.update_mods, openkh.mods_check_interval, openkh.mods_last_check):
       print('Updating mods')
       mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
       if mods.exists():
-         for game in mods.iterdir():
-            if not game.is_dir():
-               continue
-            for root, folders, _files in game.walk():
-               if '.git' not in folders:
+         with PROFILER.span('git'):
+            for game in mods.iterdir():
+               if not game.is_dir():
                   continue
-               print(f'Checking for updates for mod {root.name}')
-               old_hash = subprocess.run(
-                  ['git', 'rev-parse', 'HEAD'],
-                  cwd=root,
-                  check=True,
-                  stdout=subprocess.PIPE
-               ).stdout
-               subprocess.run(
-                  ['git', 'pull', '--recurse-submodules'],
-                  cwd=root,
-                  check=True
-               )
-               new_hash = subprocess.run(
-                  ['git', 'rev-parse', 'HEAD'],
-                  cwd=root,
-                  check=True,
-                  stdout=subprocess.PIPE
-               ).stdout
-               if old_hash != new_hash:
-                  rebuild.add(game.name)
+               for root, folders, _files in game.walk():
+                  if '.git' not in folders:
+                     continue
+                  print(f'Checking for updates for mod {root.name}')
+                  with PROFILER.span('pull') as span:
+                     span.args['mod'] = str(root.relative_to(mods))
+                     fetch_git_mirror(root, settings)
+                     old_hash = run_process(
+                        ['git', 'rev-parse', 'HEAD'],
+                        cwd=root,
+                        check=True,
+                        stdout=subprocess.PIPE
+                     ).stdout
+                     run_process(
+                        ['git', 'pull', '--recurse-submodules'],
+                        cwd=root,
+                        check=True
+                     )
+                     new_hash = run_process(
+                        ['git', 'rev-parse', 'HEAD'],
+                        cwd=root,
+                        check=True,
+                        stdout=subprocess.PIPE
+                     ).stdout
+                  EVENTS.emit('git', action='pull', mod=str(root.relative_to(mods)), old=old_hash.decode('utf-8').strip(), new=new_hash.decode('utf-8').strip(), changed=old_hash != new_hash)
+                  if old_hash != new_hash:
+                     rebuild.add(game.name)
+      if openkh.mods_check_interval is not None:
+         openkh.mods_last_check = now()
+         save_settings_locked(settings, settings_path)
 
    if settings.games.kh15_25 is not None:
-      mod_game(settings.games.kh15_25, {'kh1': 'KH1', 'kh2': 'KH2', 'bbs': 'BBS', 'Recom': 'ReCoM'}, rebuild, openkh, openkh_settings, environment, settings, settings_path)
+      with PROFILER.span('kh15_25'):
+         mod_game(settings.games.kh15_25, MOD_GAME_IDS['kh15_25'], rebuild, openkh, openkh_settings, environment, settings, settings_path)
    if settings.games.kh28 is not None:
-      mod_game(settings.games.kh28, {'kh3d': 'KH3D'}, rebuild, openkh, openkh_settings, environment, settings, settings_path)
+      with PROFILER.span('kh28'):
+         mod_game(settings.games.kh28, MOD_GAME_IDS['kh28'], rebuild, openkh, openkh_settings, environment, settings, settings_path)
+
+class ToolRunner(abc.ABC):
+   budget: ResourceBudget | None = None
+   cpus = 0
+   memory = 0
+
+   @abc.abstractmethod
+   def path(self, path: pathlib.Path | pathlib.PureWindowsPath) -> str: pass
+   @abc.abstractmethod
+   def launch(self, tool: pathlib.Path, args: list[str]): pass
+
+   def run(self, tool: pathlib.Path, args: list[str]):
+      EVENTS.emit('tool_start', tool=tool.name, command=args[:2], runner=type(self).__name__)
+      start = time.perf_counter()
+      exit_code = 0
+      try:
+         with tool_lock(tool.parent, shared=True), self.budget.use(self.cpus, self.memory) if self.budget is not None else contextlib.nullcontext():
+            self.launch(tool, args)
+      except subprocess.CalledProcessError as error:
+         exit_code = error.returncode
+         raise
+      finally:
+         EVENTS.emit('tool_end', tool=tool.name, command=args[:2], exit_code=exit_code, seconds=round(time.perf_counter() - start, 3))
+
+class EnvironmentToolRunner(ToolRunner):
+   def __init__(self, environment: Environment, game: KhGame):
+      self.environment = environment
+      self.game = game
+
+   def path(self, path: pathlib.Path | pathlib.PureWindowsPath) -> str:
+      if isinstance(path, pathlib.PureWindowsPath):
+         return str(path)
+      return str(self.environment.convert_path(self.game, path))
+
+   def launch(self, tool: pathlib.Path, args: list[str]):
+      self.environment.run_program(self.game, [str(tool.with_name(tool.name + '.exe')), *args])
+
+class DotnetToolRunner(ToolRunner):
+   def __init__(self, dotnet: str, environment: Environment, game: KhGame):
+      self.dotnet = dotnet
+      self.environment = environment
+      self.game = game
+      self.converted: dict[pathlib.PureWindowsPath, pathlib.Path] = {}
+
+   def path(self, path: pathlib.Path | pathlib.PureWindowsPath) -> str:
+      if isinstance(path, pathlib.PureWindowsPath):
+         if path not in self.converted:
+            self.converted[path] = self.environment.convert_path_back(self.game, path)
+         return str(self.converted[path])
+      return str(path)
+
+   def launch(self, tool: pathlib.Path, args: list[str]):
+      run_process([self.dotnet, str(tool.with_name(tool.name + '.dll')), *args], check=True)
+
+def native_dotnet(tool: pathlib.Path) -> str | None:
+   runtime_config = tool.with_name(tool.name + '.runtimeconfig.json')
+   if not tool.with_name(tool.name + '.dll').exists() or not runtime_config.exists():
+      return None
+   dotnet = shutil.which('dotnet')
+   if dotnet is None and 'DOTNET_ROOT' in os.environ:
+      dotnet = shutil.which('dotnet', path=os.environ['DOTNET_ROOT'])
+   if dotnet is None:
+      return None
+   with open(runtime_config, 'r', encoding='utf-8') as config_file:
+      options = json.load(config_file)['runtimeOptions']
+   frameworks = options.get('frameworks', [options['framework']] if 'framework' in options else [])
+   runtimes = run_process([dotnet, '--list-runtimes'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+   installed: dict[str, list[tuple[int, ...]]] = {}
+   for line in runtimes.splitlines():
+      name, version, *_rest = line.split(' ')
+      installed.setdefault(name, []).append(tuple(int(part) for part in version.split('-')[0].split('.')))
+   for framework in frameworks:
+      required = tuple(int(part) for part in framework['version'].split('-')[0].split('.'))
+      if not any(version[0] == required[0] and version >= required for version in installed.get(framework['name'], [])):
+         return None
+   return dotnet
+
+def tool_runner(tool: pathlib.Path, game: KhGame, openkh: OpenKh, environment: Environment, settings: Settings) -> ToolRunner:
+   runner: ToolRunner | None = None
+   if openkh.native_tools and isinstance(environment, LinuxEnvironment):
+      if (dotnet := native_dotnet(tool)) is not None:
+         runner = DotnetToolRunner(dotnet, environment, game)
+      else:
+         print(f'No native dotnet runtime found for \'{tool.name}\', running it through wine')
+   if runner is None:
+      runner = EnvironmentToolRunner(environment, game)
+   budget = settings.budget if settings.budget is not None else Budget()
+   runner.budget = resource_budget(settings)
+   runner.cpus = budget.tool_cpus
+   runner.memory = budget.tool_memory
+   return runner
 
 def mod_game(game: KhGame, ids: dict[str, str], rebuild: set[str], openkh: OpenKh, openkh_settings: dict[str, typing.Any], environment: Environment, settings: Settings, settings_path: pathlib.Path):
-   latest_modified: datetime.datetime | None = None
-   for gameid, text in ids.items():
-      enabled_mods_path = openkh.folder / f'mods-{text}.txt'
-      if enabled_mods_path.exists():
-         modified = datetime.datetime.fromtimestamp(enabled_mods_path.stat().st_mtime)
-         if latest_modified is None or modified > latest_modified:
-            latest_modified = modified
-         if openkh.last_build is None or modified > openkh.last_build:
-            rebuild.add(gameid)
-   data_folder = pathlib.PureWindowsPath(openkh_settings['gameDataPath'])
-   data_folder_local = environment.convert_path_back(game, data_folder)
-   mod_in = pathlib.PureWindowsPath(openkh_settings['modCollectionPath'])
-   mod_out = pathlib.PureWindowsPath(openkh_settings['gameModPath'])
-   image_source = game.folder / 'Image'
-   image_backup = game.folder / 'Image-BACKUP'
-   restore_folder(image_source, image_backup)
-   for gameid, text in ids.items():
-      if gameid not in rebuild:
-         continue
-      game_data_local = data_folder_local / gameid
-      if not game_data_local.exists():
-         print(f'Extracting {gameid} data (this will take some time)')
-         for root, _folders, files in image_source.walk():
-            for file in files:
-               if file.startswith(f'{gameid}_') and file.endswith('.hed'):
-                  environment.run_program(game, [
-                     str(openkh.folder / 'OpenKh.Command.IdxImg.exe'),
-                     'hed', 'extract', '--do-not-extract-again',
-                     '--output', str(data_folder / gameid),
-                     str(environment.convert_path(game, root / file)),
+   with game_lock(game):
+      latest_modified: datetime.datetime | None = None
+      for gameid, text in ids.items():
+         enabled_mods_path = openkh.folder / f'mods-{text}.txt'
+         if enabled_mods_path.exists():
+            modified = datetime.datetime.fromtimestamp(enabled_mods_path.stat().st_mtime)
+            if latest_modified is None or modified > latest_modified:
+               latest_modified = modified
+            if openkh.last_build is None or modified > openkh.last_build:
+               rebuild.add(gameid)
+      data_folder = pathlib.PureWindowsPath(openkh_settings['gameDataPath'])
+      data_folder_local = environment.convert_path_back(game, data_folder)
+      mod_in = pathlib.PureWindowsPath(openkh_settings['modCollectionPath'])
+      mod_out = pathlib.PureWindowsPath(openkh_settings['gameModPath'])
+      image_source = game.folder / 'Image'
+      image_backup = game.folder / 'Image-BACKUP'
+      restore_folder(image_source, image_backup)
+      mod_out_local: pathlib.Path | None = None
+      idx_img = openkh.folder / 'OpenKh.Command.IdxImg'
+      runner: ToolRunner | None = None
+      for gameid, text in ids.items():
+         with build_lock(openkh.folder / f'mods-{text}.txt'):
+            pristine_modules = openkh.folder / 'refined-modules' / gameid
+            modules_changed = False
+            disabled_modules = settings.mods.refined.disabled_modules if settings.mods.refined is not None else []
+            missing_pristine = not pristine_modules.exists() and len(disabled_modules) > 0
+            build = gameid in rebuild or missing_pristine
+            if build:
+               game_data_local = data_folder_local / gameid
+               if not game_data_local.exists():
+                  print(f'Extracting {gameid} data (this will take some time)')
+                  with PROFILER.span(f'extract {gameid}'):
+                     if runner is None:
+                        runner = tool_runner(idx_img, game, openkh, environment, settings)
+                     for root, _folders, files in image_source.walk():
+                        for file in files:
+                           if file.startswith(f'{gameid}_') and file.endswith('.hed'):
+                              runner.run(idx_img, [
+                                 'hed', 'extract', '--do-not-extract-again',
+                                 '--output', runner.path(data_folder / gameid),
+                                 runner.path(root / file),
+                              ])
+                              pathlib.Path('OpenKh.Command.IdxImg.log').unlink(missing_ok=True)
+                     for entry in (game_data_local / 'original').iterdir():
+                        shutil.move(entry, game_data_local)
+               enabled_mods_path = openkh.folder / f'mods-{text}.txt'
+               if mod_out_local is None:
+                  mod_out_local = environment.convert_path_back(game, mod_out)
+               fingerprint = build_fingerprint(openkh, gameid, enabled_mods_path) if openkh.build_cache > 0 else None
+               if not missing_pristine and fingerprint is not None and switch_build(mod_out_local, gameid, fingerprint, pristine_modules, openkh.build_cache):
+                  print(f'Using cached {gameid} build')
+               else:
+                  print(f'Building {gameid} mods')
+                  with PROFILER.span(f'build {gameid}'):
+                     if runner is None:
+                        runner = tool_runner(idx_img, game, openkh, environment, settings)
+                     runner.run(idx_img, [
+                        'hed', 'build',
+                        '--game_id', gameid,
+                        '--output_folder', runner.path(mod_out / gameid),
+                        '--enabled_mods', runner.path(enabled_mods_path),
+                        '--mods_folder', runner.path(mod_in / gameid),
+                        '--game_data', runner.path(data_folder / gameid),
+                     ])
+                     pathlib.Path('OpenKh.Command.IdxImg.log').unlink(missing_ok=True)
+                  save_pristine_modules(mod_out_local / gameid / 'dll' / 'modules', pristine_modules)
+                  if fingerprint is not None:
+                     (mod_out_local / BUILD_CACHE).mkdir(parents=True, exist_ok=True)
+                     (mod_out_local / BUILD_CACHE / f'{gameid}.current').write_text(fingerprint, encoding='utf-8')
+            if pristine_modules.exists():
+               if mod_out_local is None:
+                  mod_out_local = environment.convert_path_back(game, mod_out)
+               modules_changed = sync_refined_modules(mod_out_local / gameid / 'dll' / 'modules', pristine_modules, disabled_modules)
+            if not build and not modules_changed:
+               continue
+            if openkh.panacea is None:
+               print(f'Patching {gameid} mods')
+               with PROFILER.span(f'patch {gameid}'):
+                  backup_folder(image_source, image_backup)
+                  if runner is None:
+                     runner = tool_runner(idx_img, game, openkh, environment, settings)
+                  runner.run(idx_img, [
+                     'hed', 'full-patch',
+                     '--build_folder', runner.path(mod_out / gameid),
+                     '--output_folder', runner.path(image_source),
+                     '--source_folder', runner.path(image_backup),
                   ])
                   pathlib.Path('OpenKh.Command.IdxImg.log').unlink(missing_ok=True)
-         for entry in (game_data_local / 'original').iterdir():
-            shutil.move(entry, game_data_local)
-      print(f'Building {gameid} mods')
-      enabled_mods_path = openkh.folder / f'mods-{text}.txt'
-      environment.run_program(game, [
-         str(openkh.folder / 'OpenKh.Command.IdxImg.exe'),
-         'hed', 'build',
-         '--game_id', gameid,
-         '--output_folder', str(mod_out / gameid),
-         '--enabled_mods', str(environment.convert_path(game, enabled_mods_path)),
-         '--mods_folder', str(mod_in / gameid),
-         '--game_data', str(data_folder / gameid),
-      ])
-      pathlib.Path('OpenKh.Command.IdxImg.log').unlink(missing_ok=True)
-      if (refined := settings.mods.refined) is not None and len(refined.disabled_modules) > 0:
-         modules_folder = environment.convert_path_back(game, mod_out) / gameid / 'dll' / 'modules'
-         if modules_folder.exists():
-            for entry in refined.disabled_modules:
-               module_path = modules_folder / f'ModuleRF-{entry}.dll'
-               module_path.unlink(missing_ok=True)
-      if openkh.panacea is None:
-         print(f'Patching {gameid} mods')
-         backup_folder(image_source, image_backup)
-         environment.run_program(game, [
-            str(openkh.folder / 'OpenKh.Command.IdxImg.exe'),
-            'hed', 'full-patch',
-            '--build_folder', str(mod_out / gameid),
-            '--output_folder', str(environment.convert_path(game, image_source)),
-            '--source_folder', str(environment.convert_path(game, image_backup)),
-         ])
-         pathlib.Path('OpenKh.Command.IdxImg.log').unlink(missing_ok=True)
-
-   if latest_modified is not None and (openkh.last_build is None or latest_modified > openkh.last_build):
-      openkh.last_build = latest_modified
-      save_settings(settings, settings_path)
 
-def check_luabackend(luabackend: Luabackend, openkh_settings: dict[str, typing.Any] | None, symlinks: Symlinks, environment: Environment, settings: Settings, settings_path: pathlib.Path):
+      if latest_modified is not None and (openkh.last_build is None or latest_modified > openkh.last_build):
+         openkh.last_build = latest_modified
+         save_settings_locked(settings, settings_path)
+
+BUILD_CACHE = '.kh-builds'
+
+def mod_signature(folder: pathlib.Path) -> str | None:
+   if not folder.exists():
+      return None
+   digest = hashlib.sha256()
+   if (head := git_head(folder)) is not None:
+      digest.update(head.encode('utf-8'))
+      status = run_process(['git', 'status', '--porcelain', '-z', '--untracked-files=all'], cwd=folder, check=True, stdout=subprocess.PIPE).stdout
+      for entry in status.decode('utf-8', errors='replace').split('\0'):
+         if entry == '':
+            continue
+         try:
+            stats = (folder / entry[3:]).stat()
+            digest.update(repr((entry, stats.st_size, stats.st_mtime_ns)).encode('utf-8'))
+         except OSError:
+            digest.update(repr((entry, None)).encode('utf-8'))
+      return digest.hexdigest()
+   for path, stats in sorted(scan_files(folder, set()), key=lambda x: x[0]):
+      digest.update(repr((str(path.relative_to(folder)), stats.st_size, stats.st_mtime_ns)).encode('utf-8'))
+   return digest.hexdigest()
+
+def build_fingerprint(openkh: OpenKh, gameid: str, enabled_mods_path: pathlib.Path) -> str:
+   mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
+   digest = hashlib.sha256()
+   digest.update(repr(str(openkh.update)).encode('utf-8'))
+   enabled = enabled_mods_path.read_text(encoding='utf-8') if enabled_mods_path.exists() else ''
+   for line in enabled.splitlines():
+      digest.update(repr((line, mod_signature(mods / gameid / line))).encode('utf-8'))
+   return digest.hexdigest()[:16]
+
+def switch_build(mod_out: pathlib.Path, gameid: str, fingerprint: str, pristine: pathlib.Path, keep: int) -> bool:
+   output = mod_out / gameid
+   cache = mod_out / BUILD_CACHE / gameid
+   marker = mod_out / BUILD_CACHE / f'{gameid}.current'
+   current = marker.read_text(encoding='utf-8').strip() if marker.exists() else None
+   if current == fingerprint and output.exists():
+      return True
+   if current is not None and output.exists():
+      stash = cache / current
+      if stash.exists():
+         shutil.rmtree(stash)
+      stash.mkdir(parents=True)
+      shutil.move(output, stash / 'output')
+      if pristine.exists():
+         shutil.move(pristine, stash / 'pristine')
+      marker.unlink()
+   cached = cache / fingerprint
+   hit = (cached / 'output').exists()
+   if hit:
+      if output.exists():
+         shutil.rmtree(output)
+      shutil.move(cached / 'output', output)
+      if pristine.exists():
+         shutil.rmtree(pristine)
+      if (cached / 'pristine').exists():
+         shutil.move(cached / 'pristine', pristine)
+      shutil.rmtree(cached)
+      marker.write_text(fingerprint, encoding='utf-8')
+   if cache.exists():
+      builds = sorted(cache.iterdir(), key=lambda x: x.stat().st_mtime, reverse=True)
+      for build in builds[keep:]:
+         print(f'Evicting cached {gameid} build {build.name}')
+         shutil.rmtree(build)
+   return hit
+
+def save_pristine_modules(modules_folder: pathlib.Path, pristine: pathlib.Path):
+   if pristine.exists():
+      shutil.rmtree(pristine)
+   if modules_folder.exists():
+      shutil.copytree(modules_folder, pristine)
+
+def sync_refined_modules(modules_folder: pathlib.Path, pristine: pathlib.Path, disabled_modules: list[str]) -> bool:
+   disabled = {f'ModuleRF-{entry}.dll' for entry in disabled_modules}
+   changed = False
+   modules_folder.mkdir(parents=True, exist_ok=True)
+   for module in pristine.iterdir():
+      target = modules_folder / module.name
+      if module.name in disabled:
+         if target.exists():
+            print(f'Disabling reFined module {module.name}')
+            target.unlink()
+            changed = True
+         continue
+      source_stat = module.stat()
+      try:
+         target_stat = target.stat()
+         if target_stat.st_size == source_stat.st_size and target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+            continue
+      except FileNotFoundError:
+         pass
+      print(f'Enabling reFined module {module.name}')
+      shutil.copy2(module, target)
+      changed = True
+   return changed
+
+class Inotify:
+   IN_CLOSE_WRITE = 0x8
+   IN_MOVED_FROM = 0x40
+   IN_MOVED_TO = 0x80
+   IN_CREATE = 0x100
+   IN_DELETE = 0x200
+   IN_ISDIR = 0x40000000
+   IN_CLOEXEC = 0o2000000
+   CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+   def __init__(self):
+      self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      self.fd: int = self.libc.inotify_init1(self.IN_CLOEXEC)
+      if self.fd < 0:
+         raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+      self.watches: dict[int, pathlib.Path] = {}
+
+   def add(self, path: pathlib.Path, recursive: bool):
+      watch = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.CHANGES)
+      if watch < 0:
+         print(f'Can\'t watch \'{path}\': {os.strerror(ctypes.get_errno())}')
+         return
+      self.watches[watch] = path
+      if recursive:
+         for child in path.iterdir():
+            if child.is_dir() and not child.is_symlink() and child.name != '.git':
+               self.add(child, recursive)
+
+   def read(self, timeout: float | None) -> list[tuple[pathlib.Path, int]]:
+      ready, _write, _error = select.select([self.fd], [], [], timeout)
+      if len(ready) == 0:
+         return []
+      data = os.read(self.fd, 64 * 1024)
+      events: list[tuple[pathlib.Path, int]] = []
+      offset = 0
+      while offset < len(data):
+         watch, mask, _cookie, length = struct.unpack_from('iIII', data, offset)
+         name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+         offset += 16 + length
+         if watch in self.watches:
+            events.append((self.watches[watch] / os.fsdecode(name), mask))
+      return events
+
+   def close(self):
+      os.close(self.fd)
+
+def watch_mods(settings: Settings, settings_path: pathlib.Path, debounce: float):
+   if platform.system() != 'Linux':
+      print('Watch mode needs inotify and only works on Linux')
+      return
+   if (openkh := settings.mods.openkh) is None:
+      print('OpenKh not configured in settings')
+      return
+   settings_path = settings_path.resolve()
+   environment = get_environment(settings)
+   if not prefixes_ready(environment, settings):
+      provision_prefixes(environment, settings)
+   if isinstance(environment, LinuxEnvironment) and environment.runtime == 'wine':
+      for game in settings.games.get_classic():
+         environment.prewarm(game)
+   symlinks = Symlinks(links_path(settings_path))
+   openkh_settings = check_openkh(openkh, symlinks, environment, settings, settings_path, check_updates=False, offline=True)
+   symlinks.commit()
+   mods = openkh.mods if openkh.mods is not None else openkh.folder / 'mods'
+   text_ids = {text: gameid for ids in MOD_GAME_IDS.values() for gameid, text in ids.items()}
+   game_ids = set(text_ids.values())
+   inotify = Inotify()
+   inotify.add(openkh.folder, recursive=False)
+   inotify.add(settings_path.parent, recursive=False)
+   if mods.exists():
+      inotify.add(mods, recursive=True)
+   settings_data = settings_path.read_bytes()
+   print(f'Watching for changes (debounce {debounce}s), press Ctrl+C to stop')
+   try:
+      while True:
+         changed: set[str] = set()
+         settings_changed = False
+         events = inotify.read(None)
+         while len(events) > 0:
+            for path, mask in events:
+               if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and path.name != '.git' and path.is_relative_to(mods):
+                  inotify.add(path, recursive=True)
+               if path == settings_path:
+                  settings_changed = True
+               elif path.parent == openkh.folder and path.name.startswith('mods-') and path.suffix == '.txt':
+                  if (gameid := text_ids.get(path.stem.removeprefix('mods-'))) is not None:
+                     changed.add(gameid)
+               elif path.is_relative_to(mods) and path.suffix != '.tmp' and '.git' not in (parts := path.relative_to(mods).parts):
+                  if len(parts) == 1 and path.suffix in ('.txt', '.json'):
+                     gameid = path.name.removesuffix('-collection.json').removesuffix('.txt')
+                  else:
+                     gameid = parts[0] if (mods / parts[0]).is_dir() else None
+                  if gameid in game_ids:
+                     changed.add(gameid)
+            events = inotify.read(debounce)
+         if settings_changed:
+            if settings_path.read_bytes() == settings_data:
+               settings_changed = False
+            else:
+               print('Settings changed, reloading')
+               settings = get_settings(settings_path)
+               if (openkh := settings.mods.openkh) is None:
+                  print('OpenKh no longer configured in settings')
+                  return
+         if not settings_changed and len(changed) == 0:
+            continue
+         for key, ids in MOD_GAME_IDS.items():
+            if (game := getattr(settings.games, key)) is None:
+               continue
+            selected = ids if settings_changed else {gameid: text for gameid, text in ids.items() if gameid in changed}
+            if len(selected) == 0:
+               continue
+            try:
+               with PROFILER.span(key):
+                  mod_game(game, selected, changed & set(selected), openkh, openkh_settings, environment, settings, settings_path)
+            except (subprocess.CalledProcessError, OSError) as error:
+               print(f'Error: {error}')
+         settings_data = settings_path.read_bytes()
+         print('Done, watching for changes')
+   except KeyboardInterrupt:
+      pass
+   finally:
+      inotify.close()
+
+def cache_folder(settings: Settings) -> pathlib.Path:
+   if settings.cache is not None:
+      return settings.cache
+   if platform.system() == 'Windows':
+      base = pathlib.Path(os.environ.get('LOCALAPPDATA', pathlib.Path.home() / 'AppData/Local'))
+   else:
+      base = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
+   return base / 'kingdom-hearts-linux'
+
+def openkh_folders(openkh: OpenKh, environment: Environment, settings: Settings) -> dict[str, pathlib.Path]:
+   manager_settings = openkh.settings if openkh.settings is not None else openkh.folder / 'mods-manager.yml'
+   use_game = settings.games.kh15_25 if settings.games.kh15_25 is not None else settings.games.kh28
+   if not manager_settings.exists() or use_game is None:
+      return {}
+   with open(manager_settings, 'r', encoding='utf-8') as mods_file:
+      mgr_data = yaml.load(mods_file, yaml.CLoader)
+   folders: dict[str, pathlib.Path] = {}
+   for key, name in [('gameDataPath', 'OpenKh data'), ('gameModPath', 'OpenKh build output'), ('modCollectionPath', 'Mod collection')]:
+      if key in mgr_data:
+         folders[name] = environment.convert_path_back(use_game, pathlib.PureWindowsPath(mgr_data[key]))
+   return folders
+
+def storage_components(environment: Environment, settings: Settings) -> dict[str, pathlib.Path]:
+   components: dict[str, pathlib.Path] = {}
+   if (openkh := settings.mods.openkh) is not None:
+      components['OpenKh'] = openkh.folder
+      components |= openkh_folders(openkh, environment, settings)
+   for game in settings.games.get_classic():
+      components[f'Image-BACKUP ({type(game).__name__})'] = game.folder / 'Image-BACKUP'
+   if (luabackend := settings.mods.luabackend) is not None:
+      components['LuaBackend'] = luabackend.folder
+   if (refined := settings.mods.refined) is not None:
+      components['reFined'] = refined.folder
+   if (randomizer := settings.mods.randomizer) is not None:
+      components['Randomizer'] = randomizer.folder
+   if (kh3 := settings.mods.kh3) is not None:
+      components['KH3 mods'] = kh3.folder
+   for game in settings.games.get_all():
+      if game.wineprefix is not None:
+         components.setdefault(f'Wineprefix ({game.wineprefix.name})', game.wineprefix)
+      if game.saves is not None:
+         components.setdefault(f'Saves ({game.saves.name})', game.saves)
+   if settings.shader_cache is not None:
+      components['Shader cache'] = settings.shader_cache
+   components['Cache'] = cache_folder(settings)
+   return {name: folder for name, folder in components.items() if folder.exists()}
+
+def scan_files(folder: pathlib.Path, exclude: set[pathlib.Path]) -> list[tuple[pathlib.Path, os.stat_result]]:
+   found: list[tuple[pathlib.Path, os.stat_result]] = []
+   pending = [folder]
+   while len(pending) > 0:
+      current = pending.pop()
+      try:
+         with os.scandir(current) as scan:
+            for entry in scan:
+               path = pathlib.Path(entry.path)
+               if entry.is_dir(follow_symlinks=False):
+                  if path not in exclude:
+                     pending.append(path)
+               elif entry.is_file(follow_symlinks=False):
+                  found.append((path, entry.stat(follow_symlinks=False)))
+      except (FileNotFoundError, PermissionError):
+         continue
+   return found
+
+def report_storage(settings: Settings, dedup: bool):
+   environment = get_environment(settings)
+   components = storage_components(environment, settings)
+   folders = set(components.values())
+   scanned: dict[str, list[tuple[pathlib.Path, os.stat_result]]] = {}
+   with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      futures = {name: executor.submit(scan_files, folder, {other for other in folders if other != folder and other.is_relative_to(folder)}) for name, folder in components.items()}
+      for name, future in futures.items():
+         scanned[name] = future.result()
+   seen: set[tuple[int, int]] = set()
+   width = max([len('Component'), *(len(name) for name in components)])
+   print(f'{"Component":<{width}}  {"Files":>8}  {"Size":>10}  {"Unique":>10}')
+   total = 0
+   for name, files in scanned.items():
+      size = 0
+      unique = 0
+      for _path, stats in files:
+         size += stats.st_size
+         if (stats.st_dev, stats.st_ino) not in seen:
+            seen.add((stats.st_dev, stats.st_ino))
+            unique += stats.st_size
+      total += unique
+      print(f'{name:<{width}}  {len(files):>8}  {format_size(size):>10}  {format_size(unique):>10}')
+   print(f'Total on disk: {format_size(total)}')
+   if dedup:
+      protected = [name for name in scanned if name in ('OpenKh data', 'OpenKh build output') or name.startswith('Image-BACKUP')]
+      unshare_files([entry for name in protected for entry in scanned[name]])
+      if 'Mod collection' in scanned:
+         dedup_files(scanned['Mod collection'], cache_folder(settings) / 'hashes.json')
+
+def hash_file(path: pathlib.Path) -> str:
+   with open(path, 'rb') as file:
+      return hashlib.file_digest(file, 'sha256').hexdigest()
+
+def unshare_files(files: list[tuple[pathlib.Path, os.stat_result]]):
+   unshared = 0
+   for path, stats in files:
+      if stats.st_nlink <= 1:
+         continue
+      temp_path = path.with_name(path.name + '.dedup')
+      try:
+         shutil.copy2(path, temp_path)
+         os.replace(temp_path, path)
+      except OSError as error:
+         temp_path.unlink(missing_ok=True)
+         print(f'Can\'t unlink \'{path}\' from its copies: {error}')
+         continue
+      unshared += 1
+   if unshared > 0:
+      print(f'Gave {unshared} hardlinked files in the OpenKh data, build output and Image-BACKUP their own copy')
+
+def dedup_files(files: list[tuple[pathlib.Path, os.stat_result]], hash_cache_path: pathlib.Path):
+   hash_cache: dict[str, list[typing.Any]] = {}
+   if hash_cache_path.exists():
+      with open(hash_cache_path, 'r', encoding='utf-8') as cache_file:
+         hash_cache = json.load(cache_file)
+   by_size: dict[tuple[int, int], list[tuple[pathlib.Path, os.stat_result]]] = {}
+   for path, stats in files:
+      if stats.st_size >= 4096:
+         by_size.setdefault((stats.st_dev, stats.st_size), []).append((path, stats))
+   to_hash: dict[tuple[int, int], tuple[pathlib.Path, os.stat_result]] = {}
+   for group in by_size.values():
+      if len({stats.st_ino for _path, stats in group}) > 1:
+         for path, stats in group:
+            to_hash.setdefault((stats.st_dev, stats.st_ino), (path, stats))
+   hashes: dict[tuple[int, int], str] = {}
+   missing: list[tuple[tuple[int, int], pathlib.Path]] = []
+   for key, (path, stats) in to_hash.items():
+      cached = hash_cache.get(f'{key[0]}:{key[1]}')
+      if cached is not None and cached[0] == stats.st_size and cached[1] == stats.st_mtime_ns:
+         hashes[key] = cached[2]
+      else:
+         missing.append((key, path))
+   print(f'Hashing {len(missing)} files ({len(to_hash) - len(missing)} cached)')
+   with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      for (key, _path), digest in zip(missing, executor.map(lambda item: hash_file(item[1]), missing)):
+         hashes[key] = digest
+         stats = to_hash[key][1]
+         hash_cache[f'{key[0]}:{key[1]}'] = [stats.st_size, stats.st_mtime_ns, digest]
+   by_hash: dict[tuple[int, str], list[tuple[pathlib.Path, os.stat_result]]] = {}
+   for path, stats in files:
+      if (digest := hashes.get((stats.st_dev, stats.st_ino))) is not None:
+         by_hash.setdefault((stats.st_dev, digest), []).append((path, stats))
+   saved = 0
+   linked = 0
+   for group in by_hash.values():
+      group.sort(key=lambda entry: -entry[1].st_nlink)
+      canonical, canonical_stats = group[0]
+      for path, stats in group[1:]:
+         if stats.st_ino == canonical_stats.st_ino:
+            continue
+         temp_path = path.with_name(path.name + '.dedup')
+         try:
+            os.link(canonical, temp_path)
+            os.replace(temp_path, path)
+         except OSError as error:
+            temp_path.unlink(missing_ok=True)
+            print(f'Can\'t link \'{path}\': {error}')
+            continue
+         if stats.st_nlink == 1:
+            saved += stats.st_size
+         linked += 1
+   hash_cache_path.parent.mkdir(parents=True, exist_ok=True)
+   with open(hash_cache_path, 'w', encoding='utf-8') as cache_file:
+      json.dump(hash_cache, cache_file)
+   print(f'Linked {linked} files, freed {format_size(saved)}')
+
+def proton_folder(proton: Proton, settings: Settings) -> pathlib.Path:
+   folder = proton.folder if proton.folder is not None else cache_folder(settings) / 'proton'
+   return folder / proton.version
+
+def uses_umu(settings: Settings) -> bool:
+   return settings.runtime == 'umu' or any(launch.runtime == 'umu' for game in settings.games.get_all() for launch in game.get_exes())
+
+def check_proton(proton: Proton, settings: Settings, offline: bool):
+   destination = proton_folder(proton, settings)
+   if (destination / 'proton').exists():
+      return
+   with tool_lock(destination):
+      if not (destination / 'proton').exists():
+         install_proton(proton, destination, settings, offline)
+
+def install_proton(proton: Proton, destination: pathlib.Path, settings: Settings, offline: bool):
+   archive = cache_folder(settings) / 'downloads' / f'{proton.version}.tar.gz'
+   checksum = archive.with_name(f'{proton.version}.sha512sum')
+   if not archive.exists() or not checksum.exists():
+      if offline:
+         raise ValueError(f'Proton {proton.version} is not downloaded yet, run update without --offline')
+      response = http_get(f'{GITHUB_API}/repos/GloriousEggroll/proton-ge-custom/releases/tags/{proton.version}')
+      response.raise_for_status()
+      assets = {asset['name']: asset['browser_download_url'] for asset in json.loads(response.text)['assets']}
+      archive.parent.mkdir(parents=True, exist_ok=True)
+      for target in [checksum, archive]:
+         if target.name not in assets:
+            raise ValueError(f'Proton release {proton.version} has no asset \'{target.name}\'')
+         print(f'Downloading {target.name}')
+         with PROFILER.span('download') as span:
+            span.args['url'] = assets[target.name]
+            response = http_get(assets[target.name], stream=True)
+            response.raise_for_status()
+            temp = target.with_name(target.name + '.part')
+            stream_to_file(response, temp, assets[target.name])
+            temp.replace(target)
+   expected = checksum.read_text(encoding='utf-8').split()[0].lower()
+   with PROFILER.span('verify'):
+      with open(archive, 'rb') as file:
+         actual = hashlib.file_digest(file, 'sha512').hexdigest()
+   if actual != expected:
+      archive.unlink()
+      checksum.unlink()
+      raise ValueError(f'Checksum mismatch for {archive.name}, removed the download so the next update fetches it again')
+   print(f'Extracting Proton {proton.version}')
+   destination.parent.mkdir(parents=True, exist_ok=True)
+   with tempfile.TemporaryDirectory(dir=destination.parent) as temp_folder:
+      temp_folder_path = pathlib.Path(temp_folder)
+      with PROFILER.span('extract'):
+         with tarfile.open(archive, 'r:gz') as tar:
+            if hasattr(tarfile, 'data_filter'):
+               tar.extractall(temp_folder_path, filter='tar')
+            else:
+               tar.extractall(temp_folder_path)
+      extracted = next(temp_folder_path.iterdir())
+      if destination.exists():
+         shutil.rmtree(destination)
+      extracted.rename(destination)
+
+def fetch_luabackend(luabackend: Luabackend, settings: Settings, settings_path: pathlib.Path, offline: bool):
    print('Checking luabackend')
-   if (luabackend.update != False) or not luabackend.folder.exists():
-      print('Checking for luabackend updates...')
-      downloaded = download_latest(
-         last_date = luabackend.update if isinstance(luabackend.update, datetime.datetime) else None,
-         url = 'https://api.github.com/repos/Sirius902/LuaBackend/releases/latest',
-         asset_filter = lambda x: x['name'] == 'DBGHELP.zip',
-         has_extra_folder = False,
-         extract_filter = lambda x: x.name != 'LuaBackend.toml',
-         destination_folder = luabackend.folder
-      )
-      if downloaded is not None:
-         if luabackend.update != False:
+   if not luabackend.folder.exists() and offline:
+      raise ValueError(f'LuaBackend is not installed in \'{luabackend.folder}\' and can\'t be downloaded offline')
+   due = not offline and update_due(luabackend.update, luabackend.check_interval, luabackend.last_check)
+   if not due and install_settled(luabackend.folder):
+      return
+   with tool_lock(luabackend.folder):
+      intact = verify_install(luabackend.folder, offline)
+      if due or not intact:
+         print('Checking for luabackend updates...')
+         downloaded = download_latest(
+            last_date = luabackend.update if isinstance(luabackend.update, datetime.datetime) and intact else None,
+            url = f'{GITHUB_API}/repos/Sirius902/LuaBackend/releases/latest',
+            asset_filter = lambda x: x['name'] == 'DBGHELP.zip',
+            has_extra_folder = False,
+            extract_filter = lambda x: x.name != 'LuaBackend.toml',
+            destination_folder = luabackend.folder,
+            cache = cache_folder(settings) / 'downloads'
+         )
+         changed = False
+         if downloaded is not None and luabackend.update != False:
             luabackend.update = downloaded
-            save_settings(settings, settings_path)
+            changed = True
+         if luabackend.check_interval is not None:
+            luabackend.last_check = now()
+            changed = True
+         if changed:
+            save_settings_locked(settings, settings_path)
+
+def check_luabackend(luabackend: Luabackend, openkh_settings: dict[str, typing.Any] | None, symlinks: Symlinks, environment: Environment, settings: Settings, settings_path: pathlib.Path, offline: bool, fetch: bool = True):
+   if fetch:
+      fetch_luabackend(luabackend, settings, settings_path, offline)
    if not luabackend.settings.exists():
       print('Creating default luabackend settings')
       with open(luabackend.settings, 'w', encoding='utf-8') as mods_file:
@@ -1038,22 +2861,235 @@ def check_luabackend(luabackend: Luabackend, openkh_settings: dict[str, typing.A
          else:
             symlinks.make(folder / 'LuaBackend.dll', luabackend.folder / 'DBGHELP.dll', is_dir=False)
 
-def check_randomizer(randomizer: Randomizer, settings: Settings, settings_path: pathlib.Path):
+def check_randomizer(randomizer: Randomizer, settings: Settings, settings_path: pathlib.Path, offline: bool):
    print('Checking randomizer')
-   if (randomizer.update != False) or not randomizer.folder.exists():
-      print('Checking for randomizer updates...')
-      downloaded = download_latest(
-         last_date = randomizer.update if isinstance(randomizer.update, datetime.datetime) else None,
-         url = 'https://api.github.com/repos/tommadness/KH2Randomizer/releases/latest',
-         asset_filter = lambda x: x['name'] == 'Kingdom.Hearts.II.Final.Mix.Randomizer.zip',
-         has_extra_folder = False,
-         extract_filter = None,
-         destination_folder = randomizer.folder
-      )
-      if downloaded is not None:
-         if randomizer.update != False:
+   if not randomizer.folder.exists() and offline:
+      raise ValueError(f'Randomizer is not installed in \'{randomizer.folder}\' and can\'t be downloaded offline')
+   due = not offline and update_due(randomizer.update, randomizer.check_interval, randomizer.last_check)
+   if not due and install_settled(randomizer.folder):
+      return
+   with tool_lock(randomizer.folder):
+      intact = verify_install(randomizer.folder, offline)
+      if due or not intact:
+         print('Checking for randomizer updates...')
+         downloaded = download_latest(
+            last_date = randomizer.update if isinstance(randomizer.update, datetime.datetime) and intact else None,
+            url = f'{GITHUB_API}/repos/tommadness/KH2Randomizer/releases/latest',
+            asset_filter = lambda x: x['name'] == 'Kingdom.Hearts.II.Final.Mix.Randomizer.zip',
+            has_extra_folder = False,
+            extract_filter = None,
+            destination_folder = randomizer.folder,
+            cache = cache_folder(settings) / 'downloads'
+         )
+         changed = False
+         if downloaded is not None and randomizer.update != False:
             randomizer.update = downloaded
-            save_settings(settings, settings_path)
+            changed = True
+         if randomizer.check_interval is not None:
+            randomizer.last_check = now()
+            changed = True
+         if changed:
+            save_settings_locked(settings, settings_path)
+
+HTTP_TIMEOUT = (10, 60)
+HTTP_RATE_LIMIT_WAIT = 120
+HTTP_SESSION: requests.Session | None = None
+RELEASES: dict[str, str] = {}
+KEY_LOCKS: dict[str, threading.Lock] = {}
+KEY_LOCKS_LOCK = threading.Lock()
+GIT_MIRRORS = False
+GIT_MIRRORS_FETCHED: set[str] = set()
+
+def key_lock(key: str) -> threading.Lock:
+   with KEY_LOCKS_LOCK:
+      if key not in KEY_LOCKS:
+         KEY_LOCKS[key] = threading.Lock()
+      return KEY_LOCKS[key]
+
+def git_mirror(url: str, settings: Settings) -> pathlib.Path | None:
+   if not GIT_MIRRORS:
+      return None
+   mirror = cache_folder(settings) / 'git' / (hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '.git')
+   with key_lock(str(mirror)):
+      if url in GIT_MIRRORS_FETCHED:
+         return mirror
+      try:
+         if (mirror / 'objects').exists():
+            run_process(['git', 'fetch', '--prune', '--quiet', 'origin'], cwd=mirror, check=True)
+         else:
+            mirror.parent.mkdir(parents=True, exist_ok=True)
+            run_process(['git', 'clone', '--mirror', '--quiet', url, str(mirror)], check=True)
+            run_process(['git', 'config', 'gc.auto', '0'], cwd=mirror, check=True)
+      except subprocess.CalledProcessError as error:
+         print(f'Can\'t update shared git objects for \'{url}\': {error}')
+         return None
+      GIT_MIRRORS_FETCHED.add(url)
+      return mirror
+
+def fetch_git_mirror(repository: pathlib.Path, settings: Settings):
+   if not GIT_MIRRORS:
+      return
+   url = run_process(['git', 'config', '--get', 'remote.origin.url'], cwd=repository, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+   if url == '' or (mirror := git_mirror(url, settings)) is None:
+      return
+   try:
+      run_process(['git', 'fetch', '--quiet', '--tags', str(mirror), '+refs/heads/*:refs/remotes/origin/*'], cwd=repository, check=True)
+   except subprocess.CalledProcessError as error:
+      print(f'Can\'t fetch shared git objects from \'{mirror}\' into \'{repository}\': {error}')
+
+def http_session() -> requests.Session:
+   global HTTP_SESSION
+   if HTTP_SESSION is None:
+      session = requests.Session()
+      retry = requests.adapters.Retry(
+         total=5,
+         backoff_factor=1,
+         status_forcelist=[500, 502, 503, 504],
+         allowed_methods=['GET', 'HEAD'],
+         respect_retry_after_header=True,
+         raise_on_status=False
+      )
+      adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      session.headers['User-Agent'] = 'kingdom-hearts-linux'
+      HTTP_SESSION = session
+   return HTTP_SESSION
+
+def rate_limit_wait(response: requests.Response) -> float | None:
+   if response.status_code not in (403, 429):
+      return None
+   if (retry_after := response.headers.get('Retry-After')) is not None:
+      try:
+         return float(retry_after)
+      except ValueError:
+         return None
+   if response.headers.get('X-RateLimit-Remaining') == '0' and (reset := response.headers.get('X-RateLimit-Reset')) is not None:
+      return max(0.0, float(reset) - time.time()) + 1
+   return None
+
+def http_get(url: str, stream: bool = False, headers: dict[str, str] | None = None) -> requests.Response:
+   headers = dict(headers or {})
+   if url.startswith(GITHUB_API):
+      headers['Accept'] = 'application/vnd.github+json'
+      if (token := os.environ.get('GITHUB_TOKEN', os.environ.get('GH_TOKEN'))) is not None:
+         headers['Authorization'] = f'Bearer {token}'
+   while True:
+      response = http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=stream)
+      wait = rate_limit_wait(response)
+      if wait is None:
+         return response
+      if wait > HTTP_RATE_LIMIT_WAIT:
+         print(f'GitHub rate limit exceeded, resets in {int(wait)} seconds (set GITHUB_TOKEN to raise the limit)')
+         return response
+      print(f'Rate limited, retrying in {int(wait)} seconds')
+      response.close()
+      time.sleep(wait)
+
+def stream_to_file(response: requests.Response, path: pathlib.Path, url: str):
+   start = time.perf_counter()
+   size = 0
+   with open(path, 'wb') as file:
+      for chunk in response.iter_content(chunk_size=1024 * 1024):
+         file.write(chunk)
+         size += len(chunk)
+   seconds = time.perf_counter() - start
+   EVENTS.emit('download', url=url, mode='full', bytes=size, seconds=round(seconds, 3), bytes_per_second=round(size / seconds) if seconds > 0 else None)
+
+def http_range(url: str, start: int, end: int | None) -> tuple[bytes, int] | None:
+   response = http_get(url, stream=True, headers={'Range': f'bytes={start}-{"" if end is None else end}' if start >= 0 else f'bytes={start}'})
+   with response:
+      content_range = response.headers.get('Content-Range', '')
+      if response.status_code != 206 or '/' not in content_range:
+         return None
+      return response.content, int(content_range.rsplit('/', 1)[1])
+
+def delta_update(url: str, manifest: dict[str, typing.Any], destination_folder: pathlib.Path, extract_filter: typing.Callable[[pathlib.Path], bool] | None) -> bool:
+   tail = http_range(url, -64 * 1024, None)
+   if tail is None:
+      print('Server doesn\'t support range requests, downloading the whole archive')
+      return False
+   data, total = tail
+   fetched = len(data)
+   end_record = data.rfind(b'PK\x05\x06')
+   if end_record < 0 or len(data) - end_record < 22:
+      return False
+   _signature, _disk, _directory_disk, _disk_entries, entry_count, directory_size, directory_offset, _comment = struct.unpack_from('<IHHHHIIH', data, end_record)
+   if directory_offset == 0xFFFFFFFF or entry_count == 0xFFFF:
+      return False
+   tail_start = total - len(data)
+   if directory_offset >= tail_start:
+      directory = data[directory_offset - tail_start:directory_offset - tail_start + directory_size]
+   else:
+      directory_range = http_range(url, directory_offset, directory_offset + directory_size - 1)
+      if directory_range is None:
+         return False
+      directory = directory_range[0]
+      fetched += len(directory)
+   files: dict[str, list[int]] = manifest['files']
+   damaged = set(changed_install_files(destination_folder)[0])
+   needed: list[tuple[str, int, int, int, int, int]] = []
+   position = 0
+   for _index in range(entry_count):
+      if directory[position:position + 4] != b'PK\x01\x02':
+         return False
+      flags, method, _time, _date, crc, compressed_size, size, name_length, extra_length, comment_length, _disk_start, _internal, _external, local_offset = struct.unpack_from('<HHHHIIIHHHHHII', directory, position + 8)
+      name = directory[position + 46:position + 46 + name_length].decode('utf-8' if flags & 0x800 else 'cp437')
+      position += 46 + name_length + extra_length + comment_length
+      if name.endswith('/') or (entry := install_entry_path(name, manifest['extra_folder'])) is None:
+         continue
+      if extract_filter is not None and not extract_filter(destination_folder / entry):
+         continue
+      known = files.get(str(entry))
+      if known is not None and known[0] == size and known[2] == crc and str(entry) not in damaged:
+         continue
+      if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or flags & 0x1 or local_offset == 0xFFFFFFFF:
+         return False
+      needed.append((str(entry), method, crc, compressed_size, size, local_offset))
+   if sum(entry[3] for entry in needed) > total // 2:
+      return False
+   ranges: list[tuple[int, int, list[tuple[str, int, int, int, int, int]]]] = []
+   for entry in sorted(needed, key=lambda entry: entry[5]):
+      start = entry[5]
+      end = min(start + 30 + len(entry[0].encode('utf-8')) + 1024 + entry[3], directory_offset)
+      if len(ranges) > 0 and start - ranges[-1][1] < 64 * 1024:
+         ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end), [*ranges[-1][2], entry])
+      else:
+         ranges.append((start, end, [entry]))
+   for start, end, entries in ranges:
+      chunk_range = http_range(url, start, end - 1)
+      if chunk_range is None:
+         return False
+      chunk = chunk_range[0]
+      fetched += len(chunk)
+      for name, method, crc, compressed_size, size, local_offset in entries:
+         offset = local_offset - start
+         if chunk[offset:offset + 4] != b'PK\x03\x04':
+            return False
+         name_length, extra_length = struct.unpack_from('<HH', chunk, offset + 26)
+         data_start = offset + 30 + name_length + extra_length
+         compressed = chunk[data_start:data_start + compressed_size]
+         if len(compressed) < compressed_size:
+            exact = http_range(url, local_offset + data_start - offset, local_offset + data_start - offset + compressed_size - 1)
+            if exact is None:
+               return False
+            compressed = exact[0]
+            fetched += len(compressed)
+         contents = compressed if method == zipfile.ZIP_STORED else zlib.decompressobj(-15).decompress(compressed)
+         if len(contents) != size or zlib.crc32(contents) != crc:
+            print(f'Bad data for \'{name}\' in range update')
+            return False
+         target = destination_folder / name
+         target.parent.mkdir(parents=True, exist_ok=True)
+         temp_path = target.with_name(target.name + '.delta')
+         temp_path.write_bytes(contents)
+         temp_path.replace(target)
+         files[name] = [size, target.stat().st_mtime_ns, crc]
+   manifest['archive'] = None
+   save_install_manifest(destination_folder, manifest)
+   print(f'Updated {len(needed)} files using {format_size(fetched)} of {format_size(total)}')
+   EVENTS.emit('download', url=url, mode='delta', bytes=fetched, archive_bytes=total, files=len(needed))
+   return True
 
 def download_latest(
    last_date: datetime.datetime | None,
@@ -1061,22 +3097,36 @@ def download_latest(
    asset_filter: typing.Callable[[dict[str, typing.Any]], bool],
    has_extra_folder: bool,
    extract_filter: typing.Callable[[pathlib.Path], bool] | None,
-   destination_folder: pathlib.Path
+   destination_folder: pathlib.Path,
+   cache: pathlib.Path | None = None
 ) -> datetime.datetime | None:
-   response = requests.get(url, timeout=20)
-   if response.status_code != 200:
-      print(f'Error {response.status_code}!')
-      try:
-         print(json.loads(response.text)['message'])
-      except json.JSONDecodeError:
-         print(response.text)
-      if not destination_folder.exists():
-         response.raise_for_status()
-      return None
+   with key_lock(url):
+      release_text = RELEASES.get(url)
+      if release_text is None:
+         try:
+            with PROFILER.span('release') as span:
+               span.args['url'] = url
+               response = http_get(url)
+         except requests.RequestException as error:
+            print(f'Error: {error}')
+            if not destination_folder.exists():
+               raise
+            return None
+         if response.status_code != 200:
+            print(f'Error {response.status_code}!')
+            try:
+               print(json.loads(response.text)['message'])
+            except json.JSONDecodeError:
+               print(response.text)
+            if not destination_folder.exists():
+               response.raise_for_status()
+            return None
+         release_text = response.text
+         RELEASES[url] = release_text
    if url.endswith('/releases'):
       newest: datetime.datetime | None = None
       release: dict[str, typing.Any] | None = None
-      releases: list[dict[str, typing.Any]] = json.loads(response.text)
+      releases: list[dict[str, typing.Any]] = json.loads(release_text)
       for next_release in releases:
          release_time = datetime.datetime.fromisoformat(next_release['published_at'].replace('Z', '+00:00'))
          if newest is None or release_time > newest:
@@ -1085,7 +3135,7 @@ def download_latest(
       if release is None:
          return None
    else:
-      release = json.loads(response.text)
+      release = json.loads(release_text)
       assert release is not None
    for asset in release['assets']:
       if not asset_filter(asset):
@@ -1093,26 +3143,59 @@ def download_latest(
       asset_date = datetime.datetime.fromisoformat(asset['updated_at'].replace('Z', '+00:00'))
       if last_date is None or asset_date > last_date or not destination_folder.exists():
          print(f'Downloading update: {release["tag_name"]}')
-         response = requests.get(asset['browser_download_url'], timeout=20)
-         if response.status_code != 200:
-            print(f'Error {response.status_code}!')
-            print(response.text)
-            if not destination_folder.exists():
-               response.raise_for_status()
-            return None
+         if destination_folder.exists() and (manifest := load_install_manifest(destination_folder)) is not None and manifest['extra_folder'] == has_extra_folder:
+            try:
+               with PROFILER.span('delta') as span:
+                  span.args['url'] = asset['browser_download_url']
+                  if delta_update(asset['browser_download_url'], manifest, destination_folder, extract_filter):
+                     return asset_date
+            except (requests.RequestException, zlib.error) as error:
+               print(f'Range update failed ({error}), downloading the whole archive')
          with tempfile.TemporaryDirectory() as temp_folder:
             temp_folder_path = pathlib.Path(temp_folder)
-            temp_zip = temp_folder_path / 'archive.zip'
-            with open(temp_zip, 'wb') as file:
-               file.write(response.content)
-            destination_folder.mkdir(parents=True, exist_ok=True)
-            if has_extra_folder:
-               temp_extract = temp_folder_path / 'extract'
-               temp_extract.mkdir(parents=True, exist_ok=True)
-               extract_with_filter(temp_zip, temp_extract, extract_filter)
-               shutil.copytree(temp_extract / next(temp_extract.iterdir()), destination_folder, dirs_exist_ok=True)
+            if cache is None:
+               temp_zip = temp_folder_path / 'archive.zip'
             else:
-               extract_with_filter(temp_zip, destination_folder, extract_filter)
+               url_key = hashlib.sha256(asset['browser_download_url'].encode('utf-8')).hexdigest()[:16]
+               temp_zip = cache / f'{url_key}-{asset_date.strftime("%Y%m%d%H%M%S")}-{asset["name"]}'
+            with key_lock(str(temp_zip)):
+               if not temp_zip.exists():
+                  partial = temp_zip.with_name(temp_zip.name + '.part')
+                  partial.parent.mkdir(parents=True, exist_ok=True)
+                  try:
+                     with PROFILER.span('download') as span:
+                        span.args['url'] = asset['browser_download_url']
+                        response = http_get(asset['browser_download_url'], stream=True)
+                        if response.status_code == 200:
+                           stream_to_file(response, partial, asset['browser_download_url'])
+                  except requests.RequestException as error:
+                     print(f'Error: {error}')
+                     partial.unlink(missing_ok=True)
+                     if not destination_folder.exists():
+                        raise
+                     return None
+                  if response.status_code != 200:
+                     print(f'Error {response.status_code}!')
+                     print(response.text)
+                     if not destination_folder.exists():
+                        response.raise_for_status()
+                     return None
+                  partial.replace(temp_zip)
+                  if cache is not None:
+                     for stale in cache.glob(f'{url_key}-*'):
+                        if stale != temp_zip:
+                           stale.unlink(missing_ok=True)
+            destination_folder.mkdir(parents=True, exist_ok=True)
+            with PROFILER.span('extract'):
+               if has_extra_folder:
+                  temp_extract = temp_folder_path / 'extract'
+                  temp_extract.mkdir(parents=True, exist_ok=True)
+                  extract_with_filter(temp_zip, temp_extract, extract_filter)
+                  shutil.copytree(temp_extract / next(temp_extract.iterdir()), destination_folder, dirs_exist_ok=True)
+               else:
+                  extract_with_filter(temp_zip, destination_folder, extract_filter)
+               if zipfile.is_zipfile(temp_zip):
+                  write_install_manifest(temp_zip, cache is not None, destination_folder, has_extra_folder, extract_filter)
          return asset_date
    return None
 
@@ -1127,5 +3210,122 @@ def extract_with_filter(zip_path: pathlib.Path, destination_folder: pathlib.Path
          if not extract_filter(full_file):
             full_file.unlink()
 
+INSTALL_MANIFEST = '.kh-manifest.json'
+
+def install_entry_path(name: str, has_extra_folder: bool) -> pathlib.PurePosixPath | None:
+   parts = pathlib.PurePosixPath(name).parts
+   if has_extra_folder:
+      parts = parts[1:]
+   if len(parts) == 0:
+      return None
+   return pathlib.PurePosixPath(*parts)
+
+def write_install_manifest(archive: pathlib.Path, keep_archive: bool, destination_folder: pathlib.Path, has_extra_folder: bool, extract_filter: typing.Callable[[pathlib.Path], bool] | None):
+   files: dict[str, list[int]] = {}
+   with zipfile.ZipFile(archive) as zip_file:
+      for info in zip_file.infolist():
+         if info.is_dir() or (entry := install_entry_path(info.filename, has_extra_folder)) is None:
+            continue
+         target = destination_folder / entry
+         if extract_filter is not None and not extract_filter(target):
+            continue
+         if not target.is_file():
+            continue
+         files[str(entry)] = [info.file_size, target.stat().st_mtime_ns, info.CRC]
+   save_install_manifest(destination_folder, {
+      'archive': str(archive) if keep_archive else None,
+      'extra_folder': has_extra_folder,
+      'files': files,
+   })
+
+def load_install_manifest(folder: pathlib.Path) -> dict[str, typing.Any] | None:
+   path = folder / INSTALL_MANIFEST
+   if not path.exists():
+      return None
+   try:
+      with open(path, 'r', encoding='utf-8') as manifest_file:
+         return json.load(manifest_file)
+   except json.JSONDecodeError:
+      print(f'Ignoring unreadable install manifest \'{path}\'')
+      return None
+
+def save_install_manifest(folder: pathlib.Path, manifest: dict[str, typing.Any]):
+   path = folder / INSTALL_MANIFEST
+   temp_path = path.with_name(path.name + '.tmp')
+   with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+      json.dump(manifest, manifest_file)
+   temp_path.replace(path)
+
+def file_crc32(path: pathlib.Path) -> int:
+   crc = 0
+   with open(path, 'rb') as file:
+      while len(chunk := file.read(1024 * 1024)) > 0:
+         crc = zlib.crc32(chunk, crc)
+   return crc
+
+def changed_install_files(folder: pathlib.Path) -> tuple[list[str], list[str]]:
+   manifest = load_install_manifest(folder)
+   if manifest is None:
+      return [], []
+   broken: list[str] = []
+   suspicious: list[str] = []
+   for name, (size, mtime, _crc) in manifest['files'].items():
+      try:
+         stats = (folder / name).stat()
+      except OSError:
+         broken.append(name)
+         continue
+      if stats.st_size != size:
+         broken.append(name)
+      elif stats.st_mtime_ns != mtime:
+         suspicious.append(name)
+   return broken + suspicious, suspicious
+
+def install_settled(folder: pathlib.Path) -> bool:
+   return folder.exists() and len(changed_install_files(folder)[0]) == 0
+
+def verify_install(folder: pathlib.Path, offline: bool) -> bool:
+   if not folder.exists():
+      return False
+   changed, suspicious = changed_install_files(folder)
+   if len(changed) == 0:
+      return True
+   manifest = load_install_manifest(folder)
+   assert manifest is not None
+   broken: list[str] = []
+   with PROFILER.span('verify'):
+      for name in changed:
+         entry = manifest['files'][name]
+         if name in suspicious and file_crc32(folder / name) == entry[2]:
+            entry[1] = (folder / name).stat().st_mtime_ns
+         else:
+            broken.append(name)
+   if len(broken) == 0:
+      save_install_manifest(folder, manifest)
+      return True
+   print(f'{len(broken)} files in \'{folder}\' are missing or damaged')
+   archive = pathlib.Path(manifest['archive']) if manifest['archive'] is not None else None
+   if archive is None or not zipfile.is_zipfile(archive):
+      if offline:
+         print('No cached archive to repair them from, run update without --offline')
+         return True
+      return False
+   with PROFILER.span('repair'):
+      with zipfile.ZipFile(archive) as zip_file:
+         for info in zip_file.infolist():
+            entry = install_entry_path(info.filename, manifest['extra_folder'])
+            if entry is None or str(entry) not in broken:
+               continue
+            target = folder / entry
+            print(f'Restoring \'{target}\'')
+            target.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = target.with_name(target.name + '.repair')
+            with zip_file.open(info) as source, open(temp_path, 'wb') as destination:
+               shutil.copyfileobj(source, destination, 1024 * 1024)
+            temp_path.replace(target)
+            manifest['files'][str(entry)] = [info.file_size, target.stat().st_mtime_ns, info.CRC]
+   save_install_manifest(folder, manifest)
+   return True
+
 if __name__ == '__main__':
    main()
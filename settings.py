@@ -4,11 +4,20 @@ import dataclasses
 import typing
 import pathlib
 import datetime
+import threading
 import yaml
 
+WineRuntime = typing.Literal['wine', 'umu']
+LaunchMode = typing.Literal['start', 'direct']
+
 @dataclasses.dataclass
 class LaunchExe:
    launch: typing.Optional[pathlib.Path]
+   mode: LaunchMode = 'start'
+   runtime: typing.Optional[WineRuntime] = None
+   prewarm: bool = False
+   wrapper: list[str] = dataclasses.field(default_factory=list)
+   env: dict[str, str] = dataclasses.field(default_factory=dict)
    @classmethod
    @abc.abstractmethod
    def exe(cls) -> pathlib.PurePath: pass
@@ -171,6 +180,12 @@ class OpenKh:
    update_mods: bool
    update: bool | datetime.datetime
    last_build: typing.Optional[datetime.datetime]
+   check_interval: typing.Optional[float] = None
+   last_check: typing.Optional[datetime.datetime] = None
+   mods_check_interval: typing.Optional[float] = None
+   mods_last_check: typing.Optional[datetime.datetime] = None
+   native_tools: bool = False
+   build_cache: int = 0
 
 @dataclasses.dataclass
 class Luabackend:
@@ -178,6 +193,8 @@ class Luabackend:
    settings: pathlib.Path
    scripts: typing.Optional[pathlib.Path]
    update: bool | datetime.datetime
+   check_interval: typing.Optional[float] = None
+   last_check: typing.Optional[datetime.datetime] = None
 
 @dataclasses.dataclass
 class Refined:
@@ -189,6 +206,8 @@ class Refined:
 class Randomizer:
    folder: pathlib.Path
    update: bool | datetime.datetime
+   check_interval: typing.Optional[float] = None
+   last_check: typing.Optional[datetime.datetime] = None
 
 @dataclasses.dataclass
 class Kh3Mods:
@@ -202,8 +221,27 @@ class Mods:
    randomizer: typing.Optional[Randomizer]
    kh3: typing.Optional[Kh3Mods]
 
+@dataclasses.dataclass
+class Snapshots:
+   folder: typing.Optional[pathlib.Path] = None
+   keep: int = 10
+   on_update: bool = False
+   on_launch: bool = False
+
+@dataclasses.dataclass
+class Proton:
+   version: str
+   folder: typing.Optional[pathlib.Path] = None
+
+@dataclasses.dataclass
+class Budget:
+   workers: int = 4
+   cpus: typing.Optional[int] = None
+   memory: typing.Optional[int] = None
+   tool_cpus: int = 2
+   tool_memory: int = 2048
+
 StoreKind = typing.Literal['epic', 'steam']
-WineRuntime = typing.Literal['wine', 'umu']
 
 @dataclasses.dataclass
 class Settings:
@@ -213,12 +251,23 @@ class Settings:
    runtime: typing.Optional[WineRuntime]
    games: Games
    mods: Mods
+   shader_cache: typing.Optional[pathlib.Path] = None
+   cache: typing.Optional[pathlib.Path] = None
+   snapshots: typing.Optional[Snapshots] = None
+   proton: typing.Optional[Proton] = None
+   budget: typing.Optional[Budget] = None
+
+SAVE_LOCK = threading.Lock()
 
 def save_settings(settings: Settings, path: pathlib.Path):
-   with open(path, 'w', encoding='utf-8') as data_file:
-      data = mashumaro.codecs.yaml.YAMLEncoder(Settings, post_encoder_func=lambda x: yaml.dump(x, sort_keys=False)).encode(settings)
-      assert isinstance(data, str)
-      data_file.write(data)
+   path = path.resolve()
+   temp_path = path.with_name(path.name + '.tmp')
+   with SAVE_LOCK:
+      with open(temp_path, 'w', encoding='utf-8') as data_file:
+         data = mashumaro.codecs.yaml.YAMLEncoder(Settings, post_encoder_func=lambda x: yaml.dump(x, sort_keys=False)).encode(settings)
+         assert isinstance(data, str)
+         data_file.write(data)
+      temp_path.replace(path)
 
 def get_settings(path: pathlib.Path) -> Settings:
    with open(path, 'r', encoding='utf-8') as data_file: